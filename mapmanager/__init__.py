@@ -0,0 +1,5 @@
+"""
+Sync a Garry's Mod maps directory with a server's listing. See mapmanager.session for the Python API.
+"""
+
+from mapmanager.session import MapSyncSession, SyncPlan
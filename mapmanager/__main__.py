@@ -1,3 +1,4 @@
 from mapmanager import cli
 
-cli.main()
\ No newline at end of file
+if __name__ == "__main__": # verify uses a process pool, which re-imports this module on Windows
+    cli.main()
@@ -0,0 +1,81 @@
+"""
+Rendering of nginx-style directory listings (autoindex_format html, json and xml), the formats htmllistparse reads best,
+and of Apache's mod_autoindex tables, which take htmllistparse's slower generic path.
+"""
+
+import time
+import html
+import json
+import urllib.parse
+from email.utils import formatdate
+from xml.sax.saxutils import escape, quoteattr
+
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec') # %b depends on the locale
+
+def format_date(mtime):
+    t = time.localtime(mtime)
+    return "{:02}-{}-{} {:02}:{:02}".format(t.tm_mday, MONTHS[t.tm_mon-1], t.tm_year, t.tm_hour, t.tm_min)
+
+def render_autoindex(path, entries):
+    """Return the listing page as bytes. entries is an iterable of (name, mtime, size); directory names end with a slash and have size None."""
+    title = html.escape("Index of " + path)
+    rows = []
+    for name, mtime, size in entries:
+        link = '<a href="{}">{}</a>'.format(urllib.parse.quote(name), html.escape(name))
+        rows.append("{}{} {} {:>19}\n".format(link, ' ' * max(51 - len(name), 1), format_date(mtime), '-' if size is None else size))
+    page = ('<html>\r\n<head><title>{0}</title></head>\r\n<body>\r\n<h1>{0}</h1><hr><pre><a href="../">../</a>\n{1}</pre><hr></body>\r\n</html>\r\n'
+            .format(title, ''.join(rows)))
+    return page.encode('utf-8')
+
+def render_autoindex_json(path, entries):
+    """Like render_autoindex, but in nginx's JSON format."""
+    objects = []
+    for name, mtime, size in entries:
+        o = {'name': name.rstrip('/'), 'type': 'directory' if size is None else 'file', 'mtime': formatdate(mtime, usegmt=True)}
+        if size is not None:
+            o['size'] = size
+        objects.append(json.dumps(o))
+    return ('[\n' + ',\n'.join(objects) + '\n]\n').encode('utf-8')
+
+def render_autoindex_xml(path, entries):
+    """Like render_autoindex, but in nginx's XML format."""
+    rows = []
+    for name, mtime, size in entries:
+        date = quoteattr(time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(mtime)))
+        if size is None:
+            rows.append('<directory mtime={}>{}</directory>\n'.format(date, escape(name.rstrip('/'))))
+        else:
+            rows.append('<file mtime={} size="{}">{}</file>\n'.format(date, size, escape(name)))
+    return ('<?xml version="1.0"?>\n<list>\n' + ''.join(rows) + '</list>\n').encode('utf-8')
+
+def apache_size(size):
+    """Format a size like Apache's apr_strfsize: bytes up to 972, then one decimal below 10 units and none above."""
+    if size < 973:
+        return str(size)
+    for unit in 'KMGTPE':
+        size /= 1024
+        if size < 973:
+            return '{:.1f}{}'.format(size, unit) if size < 9.95 else '{:.0f}{}'.format(size, unit)
+    return '{:.0f}E'.format(size)
+
+def render_autoindex_apache(path, entries):
+    """Like render_autoindex, but as Apache's FancyIndexing table with icons and approximate sizes."""
+    title = html.escape("Index of " + path)
+    rows = []
+    for name, mtime, size in entries:
+        icon, alt = ('/icons/folder.gif', '[DIR]') if size is None else ('/icons/unknown.gif', '[   ]')
+        rows.append('<tr><td valign="top"><img src="{}" alt="{}"></td><td><a href="{}">{}</a></td><td align="right">{}  </td><td align="right">{:>4}</td><td>&nbsp;</td></tr>\n'.format(
+            icon, alt, urllib.parse.quote(name), html.escape(name), time.strftime('%Y-%m-%d %H:%M', time.localtime(mtime)), '-' if size is None else apache_size(size)))
+    page = ('<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">\n<html>\n <head>\n  <title>{0}</title>\n </head>\n <body>\n<h1>{0}</h1>\n  <table>\n'
+            '   <tr><th valign="top"><img src="/icons/blank.gif" alt="[ICO]"></th><th><a href="?C=N;O=D">Name</a></th><th><a href="?C=M;O=A">Last modified</a></th>'
+            '<th><a href="?C=S;O=A">Size</a></th><th><a href="?C=D;O=A">Description</a></th></tr>\n   <tr><th colspan="5"><hr></th></tr>\n'
+            '<tr><td valign="top"><img src="/icons/back.gif" alt="[PARENTDIR]"></td><td><a href="../">Parent Directory</a></td><td>&nbsp;</td><td align="right">  - </td><td>&nbsp;</td></tr>\n'
+            '{1}   <tr><th colspan="5"><hr></th></tr>\n</table>\n</body></html>\n').format(title, ''.join(rows))
+    return page.encode('utf-8')
+
+FORMATS = { # autoindex_format -> (renderer, Content-Type)
+    'html': (render_autoindex, 'text/html'),
+    'json': (render_autoindex_json, 'application/json'),
+    'xml': (render_autoindex_xml, 'text/xml'),
+    'apache': (render_autoindex_apache, 'text/html'),
+}
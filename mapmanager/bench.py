@@ -0,0 +1,245 @@
+"""
+End-to-end sync benchmark against a local fake fastdl server. Works offline.
+
+The server runs in its own process, serves a generated set of .bsp.bz2 maps with an nginx-style (or, with --format apache, Apache-style) listing and can inject latency, limit bandwidth and reset connections.
+The sync itself is a normal non-interactive run of cli.main, timed per phase (see cli.phase).
+
+Usage: python -m mapmanager.bench --maps 50 --size 4M --latency 0.05 --bandwidth 20M --resets 0.05
+"""
+
+import os
+import io
+import bz2
+import sys
+import time
+import struct
+import random
+import socket
+import argparse
+import tempfile
+import urllib.parse
+import contextlib
+import multiprocessing
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from email.utils import formatdate
+
+from mapmanager import cli
+from mapmanager.autoindex import FORMATS
+from mapmanager.htmllistparse import human2bytes
+from mapmanager.mapfiles import mb_fmt
+from mapmanager.verify import BSP_HEADER, BSP_LUMP, BSP_LUMP_COUNT
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+def make_bsp(size, rng):
+    """Return size bytes that look like a .bsp to verify and compress about as well as real maps (see diskspace.EXTRACT_RATIO)."""
+    header_size = BSP_HEADER.size + BSP_LUMP.size*BSP_LUMP_COUNT
+    lump = (size - header_size) // BSP_LUMP_COUNT
+    header = BSP_HEADER.pack(b'VBSP', 20) + b''.join(BSP_LUMP.pack(header_size + i*lump, lump, 0, 0) for i in range(BSP_LUMP_COUNT))
+    body = io.BytesIO()
+    block = 64*1024
+    while body.tell() < size - len(header):
+        noise = rng.randbytes(block // 3)
+        body.write(noise + bytes(block - len(noise)))
+    return header + body.getvalue()[:size - len(header)]
+
+def map_dir(i, depth, fanout=4):
+    """Subdirectory of the i-th map for a server with depth levels of subdirectories, e.g. d1/d3/ for depth 2."""
+    return os.path.join('', *('d{}'.format(i // fanout**level % fanout) for level in range(depth)))
+
+def generate_maps(directory, count, size, seed=0, depth=0):
+    """Write count compressed maps into directory, spread over depth levels of subdirectories, unless they are already there from an earlier run."""
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    mtime = time.time() - 24*60*60
+    for i in range(count):
+        path = os.path.join(directory, map_dir(i, depth), "zs_bench_{:04}_v1.bsp.bz2".format(i))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            continue
+        with open(path+'.part', 'wb') as f:
+            f.write(bz2.compress(make_bsp(size, rng), 1))
+        os.replace(path+'.part', path)
+        os.utime(path, (mtime, mtime))
+
+class FastdlHandler(BaseHTTPRequestHandler):
+    """Serves the files of server.root, with the faults configured on the server."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self, body=True):
+        time.sleep(self.server.latency)
+        rel = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path).lstrip('/')
+        path = os.path.normpath(os.path.join(self.server.root, rel))
+        if os.path.commonpath([path, self.server.root]) != self.server.root:
+            return self.send_error(404)
+        if os.path.isdir(path):
+            return self.send_listing(path, body)
+        if not os.path.isfile(path):
+            return self.send_error(404)
+        self.send_file(path, body)
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def send_listing(self, directory, body=True):
+        entries = []
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            st = os.stat(path)
+            if os.path.isdir(path):
+                entries.append((name+'/', st.st_mtime, None))
+            else:
+                entries.append((name, st.st_mtime, st.st_size))
+        rel = os.path.relpath(directory, self.server.root)
+        render, content_type = FORMATS[self.server.listing_format]
+        page = render('/' if rel == '.' else '/' + rel.replace(os.sep, '/') + '/', entries)
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(page)))
+        self.end_headers()
+        if body:
+            self.wfile.write(page)
+
+    def send_file(self, path, body=True):
+        st = os.stat(path)
+        start, end = 0, st.st_size
+        range_header = self.headers.get('Range', '')
+        partial = range_header.startswith('bytes=')
+        if partial:
+            first, last = range_header[len('bytes='):].split('-')
+            start = int(first)
+            end = min(int(last)+1, end) if last else end
+        self.send_response(206 if partial else 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Last-Modified', formatdate(st.st_mtime, usegmt=True))
+        if partial:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end-1, st.st_size))
+        self.end_headers()
+        if not body:
+            return
+
+        reset_at = None
+        if random.random() < self.server.reset_rate:
+            reset_at = random.randrange(start, end)
+        chunk_size = 16*1024
+        with open(path, 'rb') as f:
+            f.seek(start)
+            sent = start
+            while sent < end:
+                chunk = f.read(min(chunk_size, end - sent))
+                if not chunk:
+                    break
+                if reset_at is not None and sent + len(chunk) > reset_at:
+                    self.wfile.write(chunk[:reset_at - sent])
+                    self.reset()
+                    return
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                if self.server.bandwidth:
+                    time.sleep(len(chunk) / self.server.bandwidth)
+
+    def reset(self):
+        """Abort the connection with a TCP RST, like a crashed or overloaded server."""
+        self.wfile.flush()
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        self.close_connection = True
+        self.connection.close()
+
+def serve(root, count, size, latency, bandwidth, reset_rate, port_queue, listing_format='html', depth=0):
+    """Generate the maps and serve them until the process is terminated. Sends the port to port_queue once ready.
+    Runs in its own process, so that neither the generation nor the server show up in the benchmarked RSS and CPU time."""
+    generate_maps(root, count, size, depth=depth)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FastdlHandler)
+    server.daemon_threads = True
+    server.root = os.path.abspath(root)
+    server.latency = latency
+    server.bandwidth = bandwidth
+    server.reset_rate = reset_rate
+    server.listing_format = listing_format
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+def peak_rss():
+    """Peak resident set size of this process in bytes, or None if unknown."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024 # kilobytes on Linux
+
+def installed(mapsdir):
+    return {f for f in os.listdir(mapsdir) if f.endswith('.bsp')}
+
+def run_sync(url, mapsdir, operations, store=None, verbose=False, depth=0):
+    """Run cli.main once and return (elapsed seconds, newly installed maps, phase times)."""
+    before = installed(mapsdir)
+    config = {'url': url, 'maps': [mapsdir], 'operations': operations, 'yes': True, 'mindate': '2000-01-01', 'minsize': '0', 'reserve': '0', 'store': store, 'depth': depth}
+    out = sys.stdout if verbose else open(os.devnull, 'w')
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(out):
+        cli.main(config, argv=[])
+    elapsed = time.perf_counter() - start
+    if not verbose:
+        out.close()
+    return elapsed, installed(mapsdir) - before, dict(cli.phase_times)
+
+def report(label, elapsed, new_maps, compressed_sizes, phases):
+    by_name = {os.path.basename(path): size for path, size in compressed_sizes.items()} # maps are installed flat
+    downloaded = sum(by_name[m+'.bz2'] for m in new_maps)
+    print("{}: {:.2f}s, {} maps ({:.2f} maps/s), {} ({:.2f} MB/s)".format(
+        label, elapsed, len(new_maps), len(new_maps)/elapsed, mb_fmt(downloaded), downloaded/elapsed/1024/1024))
+    for name, seconds in sorted(phases.items(), key=lambda p: -p[1]):
+        print("    {: <18} {:8.3f}s".format(name, seconds))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark a full sync against a local fake fastdl server")
+    parser.add_argument('--maps', help="Number of maps on the server", type=int, default=20)
+    parser.add_argument('--size', help="Size of every extracted map. Example: 8M", default='2M')
+    parser.add_argument('--latency', help="Seconds to wait before every response", type=float, default=0)
+    parser.add_argument('--bandwidth', help="Bandwidth limit of every connection, for example 10M (bytes/s). Unlimited by default.")
+    parser.add_argument('--resets', help="Probability of a download being cut off by a connection reset", type=float, default=0)
+    parser.add_argument('--format', help="Format of the server's listings, like nginx's autoindex_format, or apache for Apache's mod_autoindex tables", choices=list(FORMATS), default='html')
+    parser.add_argument('--depth', help="Put the maps into this many levels of subdirectories and sync with --depth", type=int, default=0)
+    parser.add_argument('--runs', help="Number of syncs. The first one downloads everything, the others measure syncs with nothing to do.", type=int, default=2)
+    parser.add_argument('--data', help="Directory for the generated server files, kept between benchmarks. A temporary directory by default.")
+    parser.add_argument('--store', help="Use a map store in a temporary directory", action='store_true')
+    parser.add_argument('-v', '--verbose', help="Show the output of MapManager", action='store_true')
+    parser.add_argument('operations', help="Operations to run, as for mapmanager", default=['update', 'clean_compressed'], nargs='*')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    size = human2bytes(args.size)
+    bandwidth = human2bytes(args.bandwidth) if args.bandwidth else 0
+    with tempfile.TemporaryDirectory() as tmp:
+        root = args.data or os.path.join(tmp, 'fastdl')
+        mapsdir = os.path.join(tmp, 'maps')
+        store = os.path.join(tmp, 'store') if args.store else None
+        os.makedirs(mapsdir)
+
+        port_queue = multiprocessing.Queue()
+        server = multiprocessing.Process(target=serve, args=(root, args.maps, size, args.latency, bandwidth, args.resets, port_queue, args.format, args.depth), daemon=True)
+        server.start()
+        try:
+            port = port_queue.get()
+            url = "http://127.0.0.1:{}/".format(port)
+            compressed_sizes = {os.path.relpath(os.path.join(d, f), root): os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(root) for f in files}
+            print("Serving {} maps ({}) at {}".format(len(compressed_sizes), mb_fmt(sum(compressed_sizes.values())), url))
+            for i in range(args.runs):
+                elapsed, new_maps, phases = run_sync(url, mapsdir, args.operations, store, args.verbose, args.depth)
+                report("cold sync" if i == 0 else "warm sync", elapsed, new_maps, compressed_sizes, phases)
+        finally:
+            server.terminate()
+            server.join()
+    rss = peak_rss()
+    print("peak RSS: {}".format(mb_fmt(rss) if rss is not None else "unknown"))
+
+if __name__ == "__main__":
+    main()
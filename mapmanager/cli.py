@@ -3,15 +3,28 @@ Arg parsing, interactive input/output.
 """
 
 import argparse
+import re
 import datetime
 import operator
 import time
 import sys
 import os
+from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 from mapmanager.htmllistparse import human2bytes
-from mapmanager.mapfiles import get_local, get_remote, upgrade, remove_map, mb_fmt, extract_file, find_gmod
-from mapmanager.mapinfo import list_orphans, list_outdated, list_upgrades, list_extensions, redundant_bzs, list_unextracted, list_local_outdated
+from mapmanager.mapfiles import get_local, get_remote, iter_remote, upgrade, remove_map, mb_fmt, extract_file, find_gmod, state_path
+from mapmanager.mapinfo import list_orphans, list_outdated, list_upgrades, list_extensions, redundant_bzs, list_unextracted, list_local_outdated, list_repairs, MapFilter, DEFAULT_PREFIXES, StreamingPlanner, replan_early
+from mapmanager.store import MapStore
+from mapmanager.manifest import write_manifest
+from mapmanager.verify import HashCache, verify_maps
+from mapmanager.state import SyncState
+from mapmanager.diskspace import SpaceBudget, free_space, freed_by, upgrade_needs
+from mapmanager.crawler import ListingCache
+from mapmanager.metrics import MetricsWriter, PHASE_SECONDS
+from mapmanager.staging import staging_dir, lower_priority, activate
+from mapmanager.proxy import serve
 from functools import reduce, partial
 
 sunrust_url = "http://142.44.142.152/fastdl/garrysmod/maps/" # we don't use urljoin so the trailing slash has to be there!
@@ -67,13 +80,37 @@ def orphans_summary(orphans):
 def outdated_summary(outdated):
     generic_removal_summary(outdated, "Found outdated maps:")
 def redundant_bz2s_summary(redundant):
-    generic_removal_summary(redundant, "Found redundant .bz2 files:")
+    generic_removal_summary(redundant, "Found redundant compressed files:")
 
 def unextracted_summary(unextracted):
-    print("Found unextracted .bz2 files!")
+    print("Found unextracted compressed files!")
     for u in unextracted:
         print(map_summary(u))
 
+def broken_summary(broken):
+    print("Found broken maps:")
+    for m, reason in broken:
+        print(map_summary(m), reason)
+    print()
+
+assume_yes = False # set by --yes
+
+phase_times = defaultdict(float) # seconds spent in each phase of the last run, read by mapmanager.bench
+
+@contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phase_times[name] += time.perf_counter() - start
+
+def timed(name, f):
+    def run():
+        with phase(name):
+            return f()
+    return run
+
 def query_yes_no(question, default="yes"):# http://code.activestate.com/recipes/577058/
     """Ask a yes/no question via raw_input() and return their answer.
 
@@ -83,7 +120,10 @@ def query_yes_no(question, default="yes"):# http://code.activestate.com/recipes/
         an answer is required of the user).
 
     The "answer" return value is True for "yes" or False for "no".
+    If assume_yes is set, the question is not asked and True is returned.
     """
+    if assume_yes:
+        return True
     valid = {"yes": True, "y": True, "ye": True,
              "no": False, "n": False}
     if default is None:
@@ -106,12 +146,15 @@ def query_yes_no(question, default="yes"):# http://code.activestate.com/recipes/
             sys.stdout.write("Please respond with 'yes' or 'no' "
                              "(or 'y' or 'n').\n")
 
-def forall_prompt(action, xs, summary, prompt, cancelmsg, donemsg="Done!"):
+def run_all(action, xs):
+    for x in xs:
+        action(x)
+
+def forall_prompt(action, xs, summary, prompt, cancelmsg, donemsg="Done!", run=run_all):
     if len(xs) > 0:
         summary(xs)
         if query_yes_no(prompt):
-            for x in xs:
-                action(x)
+            run(action, xs)
             print(donemsg)
             return True
         else:
@@ -131,6 +174,16 @@ def accum_actions(actions):
 def read_date(x):
     return datetime.datetime.fromisoformat(x).timestamp()# TODO: Is this the proper way to do it? Same with reading dates from server listing.
 
+BOOLEANS = {'1': True, 'yes': True, 'true': True, 'on': True, '0': False, 'no': False, 'false': False, 'off': False, '': False}
+def read_bool(x):
+    """Flags from config.cfg are strings, read them like ConfigParser.getboolean does."""
+    if isinstance(x, str):
+        try:
+            return BOOLEANS[x.strip().lower()]
+        except KeyError:
+            raise ValueError("Not a boolean: {!r}".format(x))
+    return bool(x)
+
 def make_reporter(name):
     return partial(Reporter, name)
 class Reporter:
@@ -163,51 +216,233 @@ class Reporter:
         sys.stdout.write(self.fmt.format(**fmt_args))
 
 
-def parse_args(): #TODO: use docopt?
+def parse_args(argv=None): #TODO: use docopt?
     parser = argparse.ArgumentParser(description="Sync the downloads/maps/ directory with a server's listing",
-                                     usage="mapmanager [-h] [-u URL] [-d MINDATE] [-s MINSIZE] [-m MAPS] [operations ...]")
+                                     usage="mapmanager [-h] [-u URL] [--mirror MIRROR] [-d MINDATE] [-s MINSIZE] [-p PREFIX] [-r REGEX] [-m MAPS] [--store STORE] [--managed-only] [--reserve RESERVE] [--depth DEPTH] [--staged] [--port PORT] [--metrics-file METRICS_FILE] [--metrics-interval METRICS_INTERVAL] [-y] [operations ...]")
     parser.add_argument('-u', '--url', help="The url of the server's maps directory", default=sunrust_url)
+    parser.add_argument('--mirror', help="Another url of the same maps directory. If a download stalls, the rest of the file is requested from the mirror. Can be given several times.", action='append', default=[])
     parser.add_argument('-d', '--mindate', help="During download/update phase, ignore serverside maps older than the given date. Currently accepts only ISO 8601 format, for example 2018-10-23.", default='2018-10-01')
     parser.add_argument('-s', '--minsize', help="During download/update phase, ignore serverside maps with size smaller than the given size. Example: mapmanager --minsize 10M", default='10M')
-    parser.add_argument('-m', '--maps', help="Path to the maps/ directory. If not given, MapManager will try to find Garry's Mod automatically.")
-    parser.add_argument('operations', help="A list of operations to perform. Possible choices are: update, clean_orphans, clean_compressed, clean_outdated.", default=['update', 'clean_compressed'] ,nargs='*') #Extract intentionally not mentioned; see comment on extract_all()
-    return parser.parse_args()
+    parser.add_argument('-p', '--prefix', help="Only manage maps whose file names start with the given prefix. Can be given several times. Default: zs_ and ze_. Use --prefix '' to manage all maps.", action='append')
+    parser.add_argument('-r', '--regex', help="Only manage maps whose file names match the given regular expression.")
+    parser.add_argument('-m', '--maps', help="Path to the maps/ directory. Can be given several times to sync several directories. If not given, MapManager will try to find Garry's Mod automatically.", action='append')
+    parser.add_argument('--store', help="Path to a shared map store. Maps are downloaded into the store once and hardlinked into every maps/ directory.")
+    parser.add_argument('--managed-only', help="Let clean_orphans remove only maps that were installed by MapManager.", action='store_true')
+    parser.add_argument('--reserve', help="Free disk space to leave untouched. Downloads that would leave less free space are postponed. Example: mapmanager --reserve 2G", default='1G')
+    parser.add_argument('--depth', help="Also look for maps in subdirectories of the server's maps directory, up to the given number of levels down. Unchanged subdirectories aren't listed again.", type=int, default=0)
+    parser.add_argument('--staged', help="Download and extract maps in the background, at low CPU and disk priority, into a staging directory instead of the maps directory. The activate operation moves them in.", action='store_true')
+    parser.add_argument('--port', help="Port the serve command listens on.", type=int, default=8000)
+    parser.add_argument('--metrics-file', help="Write counters and histograms (bytes downloaded, download speeds, listing times, cache hits, failures...) to this file at the end of the run. Prometheus text format, or a JSON summary if the name ends with .json.")
+    parser.add_argument('--metrics-interval', help="Also write the metrics file every given number of seconds during the run.", type=float, default=0)
+    parser.add_argument('-y', '--yes', help="Don't ask for confirmation. New maps are downloaded while the server's listing is still loading.", action='store_true')
+    parser.add_argument('operations', help="A list of operations to perform. Possible choices are: update, clean_orphans, clean_compressed, clean_outdated, verify, activate. Alternatively, a command: manifest (write manifest.json for the maps directory, to be used on the server) or serve (run a caching proxy of the server at --url for other machines, keeping the maps in the maps directory).", default=['update', 'clean_compressed'] ,nargs='*') #Extract intentionally not mentioned; see comment on extract_all()
+    return parser.parse_args(argv)
 
-def main(config={}):
-    args = vars(parse_args())
-    args.update(config)
-    
-    minsize = human2bytes(args['minsize']) #TODO: Shouldn't this be in parse_args too?!
-    mindate = read_date(args['mindate'])
-    url = args['url']
-    op_names = args['operations']
-    mapsdir = args['maps'] or os.path.join(find_gmod(), "garrysmod/download/maps/")
+def make_upgrader(mapsdir, url, store=None, hashes=None, state=None, mirrors=(), staged=False):
+    hashes = hashes or HashCache(state_path(mapsdir, 'hashes.json'))
+    state = state or SyncState(state_path(mapsdir, 'state.sqlite3'))
+    staging = staging_dir(mapsdir) if staged else None
+    return partial(upgrade, url=url, mapsdir=mapsdir, make_reporter=make_reporter, store=store, hashes=hashes, state=state, mirrors=mirrors, staging=staging)
+
+def get_staged(mapsdir, filt, staged):
+    """Return the maps waiting in the staging directory. They count as installed when planning upgrades, so they aren't downloaded again."""
+    return get_local(staging_dir(mapsdir), filt) if staged else []
+
+def make_budget(mapsdir, store, reserve):
+    """New maps are written to the store if there is one."""
+    return SpaceBudget(store.root if store else mapsdir, reserve)
+
+def run_within_budget(budget, action, upgrades):
+    postponed = budget.run(upgrades, action)
+    if postponed:
+        print()
+        print("Not enough disk space left for {} maps (~{} needed). Free up some space and run MapManager again.".format(
+            len(postponed), mb_fmt(sum(upgrade_needs(u, budget.tmp_on_same_fs)[1] for u in postponed))))
+
+def space_summary(budget, frees, needs):
+    print("Free space: {}, reserved: {}, cleanup frees: ~{}, downloads need: ~{}".format(
+        mb_fmt(free_space(budget.path)), mb_fmt(budget.reserve), mb_fmt(frees), mb_fmt(needs)))
+
+def get_remote_upgrading(url, filt, mapsdirs, store=None, reserve=0, mirrors=(), staged=False):
+    """Fetch the remote listing and download clearly new maps (see StreamingPlanner) while it's still arriving.
+    Only for non-interactive runs, since the upgrades can't be confirmed before the whole listing is known.
+    Returns the remote MapInfos and the upgrades done in each maps directory."""
+    planners = {d: StreamingPlanner(get_local(d, filt.identity()) + get_staged(d, filt.identity(), staged), filt) for d in mapsdirs}
+    upgraders = {d: make_upgrader(d, url, store, mirrors=mirrors, staged=staged) for d in mapsdirs}
+    budgets = {d: make_budget(d, store, reserve) for d in mapsdirs} # maps that don't fit are left for the normal, batched, update
+    remote_mapinfo = []
+    early = {d: [] for d in mapsdirs}
+    with ThreadPoolExecutor(max_workers=1) as downloader: # one worker, so that a store link never races its download
+        jobs = []
+        for m in iter_remote(url, filt.identity()):
+            remote_mapinfo.append(m)
+            for mapsdir, planner in planners.items():
+                for u in planner.feed(m):
+                    if budgets[mapsdir].admit(u):
+                        early[mapsdir].append(u)
+                        jobs.append(downloader.submit(upgraders[mapsdir], u))
+        for mapsdir in mapsdirs: # if the listing wasn't sorted by name, some early downloads may not be the newest versions
+            replanned = [u for u in replan_early(early[mapsdir], remote_mapinfo, filt) if budgets[mapsdir].admit(u)]
+            early[mapsdir] += replanned
+            jobs += [downloader.submit(upgraders[mapsdir], u) for u in replanned]
+        for j in jobs:
+            j.result() # re-raise download errors
+    return remote_mapinfo, early
+
+FREEING_OPS = ['clean_orphans', 'clean_outdated', 'clean_compressed']
+LOCAL_OPS = ['activate', 'clean_outdated', 'clean_compressed', 'extract'] # operations that don't need the server's listing
+ACTIVATE_CLEANUP = ['clean_outdated', 'clean_compressed'] # run after activate if no other operations are given
+
+def sync_mapsdir(mapsdir, remote_mapinfo, url, op_names, filt, store=None, reserve=0, managed_only=False, mirrors=(), staged=False):
+    """Run the operations on one maps/ directory. Returns True if anything was done.
+    Operations that free disk space run first and downloads are postponed if they'd leave less than reserve bytes free.
+    If managed_only is set, only the orphans installed by MapManager are removed. If staged is set, upgrades go to the staging directory."""
     print("The maps directory is: "+mapsdir)
 
-    local_mapinfo = get_local(mapsdir)
-    remote_mapinfo = get_remote(url)
+    with phase('scan'):
+        state = SyncState(state_path(mapsdir, 'state.sqlite3'))
+        local_mapinfo = [m for m in get_local(mapsdir, filt.identity()) if not state.is_incomplete(m)] # interrupted downloads are downloaded again
+        upgradable_mapinfo = local_mapinfo + get_staged(mapsdir, filt.identity(), staged) # staged maps must not make live ones outdated before activation, so only upgrades see them
+        changed_remote = state.changed_remote(upgradable_mapinfo, remote_mapinfo)
     by_ext = list_extensions(local_mapinfo)
+    hashes = HashCache(state_path(mapsdir, 'hashes.json'))
+    do_upgrade = make_upgrader(mapsdir, url, store, hashes, state, mirrors, staged)
+    do_remove = partial(remove_map, mapsdir=mapsdir, state=state)
+    budget = make_budget(mapsdir, store, reserve)
+    upgrade_within_budget = partial(run_within_budget, budget)
+    removals = {
+        'clean_orphans': lambda: [m for m in list_orphans(local_mapinfo, remote_mapinfo) if not managed_only or state.is_managed(m)],
+        'clean_outdated': lambda: list_local_outdated(local_mapinfo),
+        'clean_compressed': lambda: redundant_bzs(by_ext),
+    }
 
     def upgradeall(): #TODO: We should be consistent about calling it 'update' or 'upgrade'. Upgrade seems better from package-management point of view but I'm not sure if it fits in this context.
-        upgrades = list_upgrades(local_mapinfo, remote_mapinfo, mindate, minsize)
-        return forall_prompt(partial(upgrade, url=url, mapsdir=mapsdir, make_reporter=make_reporter), upgrades, upgrade_summary, "Continue upgrade?", "Upgrade canceled!")
+        upgrades = list_upgrades(upgradable_mapinfo, changed_remote, filt)
+        return forall_prompt(do_upgrade, upgrades, upgrade_summary, "Continue upgrade?", "Upgrade canceled!", run=upgrade_within_budget)
     def remove_orphans():
-        orphans = list_orphans(local_mapinfo, remote_mapinfo)
-        return forall_prompt(partial(remove_map, mapsdir=mapsdir), orphans, orphans_summary, "Remove all orphan maps?", "No orphans deleted.")
+        orphans = removals['clean_orphans']()
+        return forall_prompt(do_remove, orphans, orphans_summary, "Remove all orphan maps?", "No orphans deleted.")
     def remove_outdated():
-        outdated = list_local_outdated(local_mapinfo)
-        return forall_prompt(partial(remove_map, mapsdir=mapsdir), outdated, outdated_summary, "Remove all outdated maps?", "No maps deleted.")
+        outdated = removals['clean_outdated']()
+        return forall_prompt(do_remove, outdated, outdated_summary, "Remove all outdated maps?", "No maps deleted.")
     def remove_redundant_bz2s():
-        redundant = redundant_bzs(by_ext)
-        return forall_prompt(partial(remove_map,mapsdir=mapsdir), redundant, redundant_bz2s_summary, "Remove all redundant files?", "No .bz2 files deleted.")
+        redundant = removals['clean_compressed']()
+        return forall_prompt(do_remove, redundant, redundant_bz2s_summary, "Remove all redundant files?", "No compressed files deleted.")
+    def repair(u):
+        if store: # a damaged hardlink means a damaged blob, which must not be linked again
+            store.discard_damaged(u.new, os.path.join(mapsdir, u.old.filename()))
+        do_upgrade(u)
+    def verify():
+        broken = verify_maps(mapsdir, local_mapinfo, remote_mapinfo, hashes)
+        if not broken:
+            return False
+        broken_summary(broken)
+        repairs = list_repairs([m for m, _ in broken], remote_mapinfo)
+        return forall_prompt(repair, repairs, upgrade_summary, "Download the broken maps again?", "No maps repaired.", run=upgrade_within_budget)
     def extract_all(): #I wouldn't worry about this one too much since it shouldn't ever be triggered in normal circumstances. Mostly for internal use (cleaning up the mess from previous, bad, implementations of the upgrade downloader)
         unextracted = list_unextracted(by_ext)
         return forall_prompt(partial(extract_file,mapsdir=mapsdir), unextracted, unextracted_summary, "Extract all?", "No files extracted.")
     
-    op_lookup = {'update': upgradeall, 'clean_orphans': remove_orphans, 'clean_compressed': remove_redundant_bz2s, 'extract': extract_all, 'clean_outdated': remove_outdated}
-    operations = [op_lookup[x] for x in op_names]
-    active = accum_actions(operations) #TODO: Make sure file removal doesn't interfere with later operations. Currently local_mapinfo is not updated after file removal.
+    op_lookup = {'update': upgradeall, 'clean_orphans': remove_orphans, 'clean_compressed': remove_redundant_bz2s, 'extract': extract_all, 'clean_outdated': remove_outdated, 'verify': verify}
+    if 'update' in op_names:
+        frees = sum(freed_by(os.path.join(mapsdir, m.filename()) for m in removals[x]()) for x in op_names if x in removals)
+        needs = sum(upgrade_needs(u, budget.tmp_on_same_fs)[1] for u in list_upgrades(upgradable_mapinfo, changed_remote, filt))
+        space_summary(budget, frees, needs)
+    ordered = [x for x in op_names if x in FREEING_OPS] + [x for x in op_names if x not in FREEING_OPS]
+    operations = [timed(x, op_lookup[x]) for x in ordered]
+    return accum_actions(operations) #TODO: Make sure file removal doesn't interfere with later operations. Currently local_mapinfo is not updated after file removal.
     #Also, currently mapmanager has to be run twice to remove old versions of just downloaded maps
+
+def make_manifests(mapsdirs):
+    for mapsdir in mapsdirs:
+        count = write_manifest(mapsdir)
+        print("Wrote manifest of {} files to {}".format(count, mapsdir))
+
+def update_phase_metrics():
+    for name, seconds in list(phase_times.items()):
+        PHASE_SECONDS.set(seconds, phase=name)
+
+def main(config={}, argv=None):
+    args = vars(parse_args(argv))
+    args.update(config)
+    phase_times.clear()
+    if not args.get('metrics_file'):
+        return sync(args)
+    writer = MetricsWriter(args['metrics_file'], float(args.get('metrics_interval') or 0), before_write=update_phase_metrics)
+    writer.start()
+    try:
+        return sync(args)
+    finally:
+        writer.stop()
+
+def sync(args):
+    """Run the command or operations given by the parsed arguments."""
+    minsize = human2bytes(args['minsize']) #TODO: Shouldn't this be in parse_args too?!
+    reserve = human2bytes(args['reserve'])
+    mindate = read_date(args['mindate'])
+    prefixes = args['prefix'] or DEFAULT_PREFIXES
+    if isinstance(prefixes, str):
+        prefixes = prefixes.split()
+    regex = re.compile(args['regex']) if args['regex'] else None
+    filt = MapFilter(prefixes=tuple(prefixes), minsize=minsize, mindate=mindate, regex=regex)
+    url = args['url']
+    mirrors = args['mirror']
+    if isinstance(mirrors, str):
+        mirrors = mirrors.split()
+    op_names = args['operations']
+    mapsdirs = args['maps'] or [os.path.join(find_gmod(), "garrysmod/download/maps/")]
+    if isinstance(mapsdirs, str):
+        mapsdirs = [mapsdirs]
+
+    commands = { # commands that don't sync anything
+        'manifest': lambda: make_manifests(mapsdirs),
+        'serve': lambda: serve(url, mapsdirs[0], int(args['port'])),
+    }
+    if op_names and op_names[0] in commands:
+        commands[op_names[0]]()
+        return
+
+    store = MapStore(args['store']) if args['store'] else None
+    depth = int(args['depth'])
+    staged = read_bool(args['staged'])
+    listing_cache = ListingCache(state_path(mapsdirs[0], 'listings.json')) if depth else None
+
+    active = False
+    if 'activate' in op_names: # before anything else, so that the maps directory changes at once
+        with phase('activate'):
+            for mapsdir in mapsdirs:
+                moved = activate(mapsdir, store)
+                if moved:
+                    print("Activated {} staged maps in {}".format(len(moved), mapsdir))
+                    active = True
+        op_names = [x for x in op_names if x != 'activate'] or ACTIVATE_CLEANUP
+
+    if staged and 'update' in op_names:
+        lower_priority()
+
+    global assume_yes
+    assume_yes = read_bool(args['yes'])
+    with phase('listing'): # includes the early downloads
+        if all(x in LOCAL_OPS for x in op_names):
+            remote_mapinfo = []
+        elif assume_yes and 'update' in op_names and not depth: # StreamingPlanner relies on the order of a single listing
+            remote_mapinfo, early = get_remote_upgrading(url, filt, mapsdirs, store, reserve, mirrors, staged)
+            for mapsdir, upgrades in early.items():
+                if upgrades:
+                    print("Upgraded while listing the server, in "+mapsdir)
+                    upgrade_summary(upgrades)
+                    print("Done!")
+                    active = True
+        else:
+            remote_mapinfo = get_remote(url, filt.identity(), depth, listing_cache) # size and date limits apply only to upgrades, see MapFilter.identity
+
+    for mapsdir in mapsdirs:
+        active = sync_mapsdir(mapsdir, remote_mapinfo, url, op_names, filt, store, reserve, read_bool(args['managed_only']), mirrors, staged) or active
+    if store:
+        with phase('store_gc'):
+            freed = store.gc()
+        if freed:
+            print("Freed {} from the store".format(mb_fmt(freed)))
     if not active:
         print("Nothing to do!")
 
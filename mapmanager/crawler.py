@@ -0,0 +1,108 @@
+"""
+Listing of servers that split their maps into subdirectories (maps/a/, maps/b/, per-gamemode directories...).
+"""
+
+import os
+import json
+import time
+import threading
+import contextlib
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+
+from mapmanager.htmllistparse import iter_listing, iter_response, FileEntry, LISTING_ACCEPT
+from mapmanager.metrics import LISTING_SECONDS, CACHE_LOOKUPS, FAILURES, host
+
+WORKERS = 4 # subdirectory listings fetched at once
+
+class ListingCache:
+    """Remembers the listings of subdirectories, so that unchanged ones aren't fetched again.
+    A subdirectory is unchanged if its modification date in the parent listing is the same as last time, or if the server answers 304 to a conditional request.
+    Listings give dates with minute precision, so a directory modified in the minute its listing was fetched is always fetched again."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock() # filled by the crawler's worker threads
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with self.lock, open(tmp, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.path)
+
+    def get(self, url):
+        with self.lock:
+            return self.entries.get(url)
+
+    def put(self, url, mtime, etag, last_modified, entries):
+        with self.lock:
+            self.entries[url] = {'mtime': mtime, 'fetched': time.time(), 'etag': etag, 'last_modified': last_modified, 'entries': [list(e) for e in entries]}
+
+def fetch_dir(session, url, mtime, cache=None, timeout=30):
+    """Return all the entries of the listing at url. mtime is the directory's modification date from the parent listing."""
+    cached = cache.get(url) if cache else None
+    if cached and mtime is not None and cached['mtime'] == mtime and mtime < cached['fetched'] - 60:
+        CACHE_LOOKUPS.inc(cache='listing', result='hit')
+        return [FileEntry(*e) for e in cached['entries']]
+    start = time.monotonic()
+    headers = {'Accept': LISTING_ACCEPT}
+    if cached and cached['etag']:
+        headers['If-None-Match'] = cached['etag']
+    if cached and cached['last_modified']:
+        headers['If-Modified-Since'] = cached['last_modified']
+    with session.get(url, headers=headers, timeout=timeout, stream=True) as req:
+        if req.status_code == 304 and cached:
+            entries = [FileEntry(*e) for e in cached['entries']]
+        else:
+            req.raise_for_status()
+            entries = list(iter_response(req)) # unfiltered, the cache must not depend on --prefix etc.
+        if cache:
+            CACHE_LOOKUPS.inc(cache='listing', result='hit' if req.status_code == 304 and cached else 'miss')
+            cache.put(url, mtime, req.headers.get('ETag'), req.headers.get('Last-Modified'), entries)
+    LISTING_SECONDS.observe(time.monotonic() - start, server=host(url))
+    return entries
+
+def crawl(url, accept_name=None, depth=0, cache=None, workers=WORKERS, timeout=30, session=None):
+    """Yield (path, FileEntry) for the files in the listing at url and its subdirectories, up to depth levels down.
+    path is the entry's directory relative to url, ending with a slash ('' for url itself).
+    The top listing is streamed; subdirectories are fetched by up to workers threads at once, over the given requests.Session if there is one."""
+    def accept(name):
+        return name.endswith('/') or not accept_name or accept_name(name)
+
+    seen = {url}
+    pending = {} # future -> (path, level)
+    with contextlib.nullcontext(session) if session else requests.Session() as session, ThreadPoolExecutor(max_workers=workers) as pool:
+        def visit(path, entries, level):
+            """Yield the files and start fetching the subdirectories."""
+            for e in entries:
+                if not e.name.endswith('/'):
+                    if accept(e.name):
+                        yield path, e
+                    continue
+                sub = url + urllib.parse.quote(path + e.name)
+                if level < depth and sub not in seen:
+                    seen.add(sub)
+                    pending[pool.submit(fetch_dir, session, sub, e.modified, cache, timeout)] = (path + e.name, level + 1)
+
+        start = time.monotonic()
+        yield from visit('', iter_listing(url, timeout, accept, session=session), 0)
+        LISTING_SECONDS.observe(time.monotonic() - start, server=host(url)) # includes the time the caller spent on the entries
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                path, level = pending.pop(f)
+                try:
+                    entries = f.result()
+                except requests.RequestException as e:
+                    print("Couldn't list {}: {}".format(url + path, e))
+                    FAILURES.inc(kind='listing', server=host(url))
+                    continue
+                yield from visit(path, entries, level)
+    if cache and depth:
+        cache.save()
@@ -0,0 +1,90 @@
+"""
+Disk space accounting for planning operations on machines with little free space.
+"""
+
+import os
+import shutil
+import tempfile
+
+from mapmanager.formats import COMPRESSED_EXTS
+
+EXTRACT_RATIO = 3 # a .bsp is usually about 3 times bigger than its .bsp.bz2 (a bit more for .bsp.xz, a bit less for .bsp.gz)
+
+def free_space(path):
+    """Return the number of bytes available to unprivileged users on the filesystem containing path."""
+    if hasattr(os, 'statvfs'):
+        st = os.statvfs(path)
+        return st.f_bavail * st.f_frsize
+    return shutil.disk_usage(path).free
+
+def same_filesystem(a, b):
+    return os.stat(a).st_dev == os.stat(b).st_dev
+
+def freed_by(paths):
+    """Estimate the space freed by removing the files. Files with other hardlinks (e.g. from a map store) free nothing."""
+    total = 0
+    for p in paths:
+        try:
+            st = os.stat(p)
+        except FileNotFoundError:
+            continue
+        if st.st_nlink <= 1:
+            total += st.st_size
+    return total
+
+def upgrade_needs(u, tmp_on_same_fs):
+    """Return (peak, final) space needed to download and extract the upgrade.
+    The download is kept in a temporary file until extraction finishes, so the peak includes both the compressed and the extracted map."""
+    final = u.new.size * EXTRACT_RATIO if u.new.ext in COMPRESSED_EXTS else u.new.size
+    peak = final + (u.new.size if tmp_on_same_fs else 0)
+    return peak, final
+
+def plan_batch(upgrades, budget, tmp_on_same_fs):
+    """Split the upgrades into a batch that fits into budget bytes and the rest.
+    Upgrades run one at a time, so an upgrade fits if its peak usage fits next to the final size of the ones admitted before it."""
+    batch = []
+    rest = []
+    committed = 0
+    for u in upgrades:
+        peak, final = upgrade_needs(u, tmp_on_same_fs)
+        if committed + peak <= budget:
+            batch.append(u)
+            committed += final
+        else:
+            rest.append(u)
+    return batch, rest
+
+class SpaceBudget:
+    """Admits downloads into the directory at path while the projected free space stays above reserve bytes."""
+    def __init__(self, path, reserve):
+        self.path = path
+        self.reserve = reserve
+        self.tmp_on_same_fs = same_filesystem(path, tempfile.gettempdir())
+        self.snapshot = None
+        self.committed = 0
+
+    def available(self):
+        return free_space(self.path) - self.reserve
+
+    def admit(self, u):
+        """Admit a single upgrade that is queued before the whole plan is known.
+        Checked against the free space measured at the first call, since earlier admitted downloads may still be running."""
+        if self.snapshot is None:
+            self.snapshot = self.available()
+        peak, final = upgrade_needs(u, self.tmp_on_same_fs)
+        if self.committed + peak > self.snapshot:
+            return False
+        self.committed += final
+        return True
+
+    def run(self, upgrades, action):
+        """Run action on the upgrades in batches that fit into the free space, measuring it again before every batch.
+        Returns the upgrades that didn't fit."""
+        remaining = list(upgrades)
+        while remaining:
+            batch, remaining = plan_batch(remaining, self.available(), self.tmp_on_same_fs)
+            if not batch:
+                break
+            for u in batch:
+                action(u)
+        return remaining
@@ -1,9 +1,12 @@
 import traceback
 import sys
+import multiprocessing
 from mapmanager import cli
 
 from configparser import ConfigParser, NoSectionError
 
+multiprocessing.freeze_support() # needed by the process pool in the pyinstaller exe
+
 try:
     cfg = ConfigParser() #TODO: move this to cli.py
     #TODO: JSON might be a better choice
@@ -16,6 +19,8 @@ try:
 
     if 'operations' in args:
         args['operations'] = args['operations'].split()
+    if 'maps' in args: # one directory per line
+        args['maps'] = [m.strip() for m in args['maps'].splitlines() if m.strip()]
 
     cli.main(args)
 except Exception:
@@ -0,0 +1,54 @@
+"""
+Formats servers offer maps in and their streaming decoders.
+"""
+
+import bz2
+import zlib
+try:
+    import lzma
+except ImportError: # Python can be built without liblzma
+    lzma = None
+
+COMPRESSED_EXTS = ('.bsp.bz2', '.bsp.xz', '.bsp.gz')
+
+class CorruptFile(ValueError):
+    """A compressed file ended before its compressed stream did, or has more data after it (e.g. a second gzip member)."""
+
+class Identity:
+    def decompress(self, data):
+        return data
+
+class Decoder:
+    """Decodes a file fed to it in order. decompress returns the data decoded so far, flush the rest."""
+    def __init__(self, decompressor):
+        self.decompressor = decompressor
+
+    def decompress(self, data):
+        try:
+            return self.decompressor.decompress(data)
+        except EOFError: # bz2 and xz refuse data after the end of the stream
+            raise CorruptFile("data after the end of the compressed stream")
+
+    def flush(self):
+        """Return the rest of the decoded data. Raises CorruptFile unless exactly one whole compressed stream was fed."""
+        d = self.decompressor
+        data = d.flush() if hasattr(d, 'flush') else b'' # only zlib buffers anything
+        if hasattr(d, 'eof') and not d.eof:
+            raise CorruptFile("truncated compressed data")
+        if getattr(d, 'unused_data', b''):
+            raise CorruptFile("{} bytes of data after the end of the compressed stream".format(len(d.unused_data)))
+        return data
+
+DECOMPRESSORS = {
+    '.bsp.bz2': bz2.BZ2Decompressor,
+    '.bsp.gz': lambda: zlib.decompressobj(16 + zlib.MAX_WBITS), # +16: expect a gzip header
+    '.bsp': Identity,
+}
+if lzma:
+    DECOMPRESSORS['.bsp.xz'] = lzma.LZMADecompressor
+
+def can_decode(ext):
+    return ext in DECOMPRESSORS
+
+def decoder(ext):
+    return Decoder(DECOMPRESSORS[ext]())
@@ -30,29 +30,63 @@ SOFTWARE.
 
 import os
 import re
+import json
 import time
+import codecs
+import calendar
 import collections
 import urllib.parse
+import xml.etree.ElementTree as ET
+from html.parser import HTMLParser
 
 import bs4
 
-RE_ISO8601 = re.compile(r'\d{4}-\d+-\d+T\d+:\d{2}:\d{2}Z')
-DATETIME_FMTs = (
-(re.compile(r'\d+-[A-S][a-y]{2}-\d{4} \d+:\d{2}:\d{2}'), "%d-%b-%Y %H:%M:%S"),
-(re.compile(r'\d+-[A-S][a-y]{2}-\d{4} \d+:\d{2}'), "%d-%b-%Y %H:%M"),
-(re.compile(r'\d{4}-\d+-\d+ \d+:\d{2}:\d{2}'), "%Y-%m-%d %H:%M:%S"),
-(RE_ISO8601, "%Y-%m-%dT%H:%M:%SZ"),
-(re.compile(r'\d{4}-\d+-\d+ \d+:\d{2}'), "%Y-%m-%d %H:%M"),
-(re.compile(r'\d{4}-[A-S][a-y]{2}-\d+ \d+:\d{2}:\d{2}'), "%Y-%b-%d %H:%M:%S"),
-(re.compile(r'\d{4}-[A-S][a-y]{2}-\d+ \d+:\d{2}'), "%Y-%b-%d %H:%M"),
-(re.compile(r'[F-W][a-u]{2} [A-S][a-y]{2} +\d+ \d{2}:\d{2}:\d{2} \d{4}'), "%a %b %d %H:%M:%S %Y"),
-(re.compile(r'[F-W][a-u]{2}, \d+ [A-S][a-y]{2} \d{4} \d{2}:\d{2}:\d{2} .+'), "%a, %d %b %Y %H:%M:%S %Z"),
-(re.compile(r'\d{4}-\d+-\d+'), "%Y-%m-%d"),
-(re.compile(r'\d+/\d+/\d{4} \d{2}:\d{2}:\d{2} [+-]\d{4}'), "%d/%m/%Y %H:%M:%S %z"),
-(re.compile(r'\d{2} [A-S][a-y]{2} \d{4}'), "%d %b %Y")
+MONTHS = {m: i+1 for i, m in enumerate(('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'))} # not calendar.month_abbr, it depends on the locale
+
+def local_epoch(y, mo, d, h=0, mi=0, sec=0):
+    # listings don't say which timezone they use; assume it's ours
+    return time.mktime((y, mo, d, h, mi, sec, 0, 0, -1))
+
+def decode_dbY(m):
+    d, b, y, h, mi, sec = m.groups()
+    return local_epoch(int(y), MONTHS[b], int(d), int(h), int(mi), int(sec or 0))
+def decode_Ymd(m):
+    y, mo, d, h, mi, sec = m.groups()
+    return local_epoch(int(y), int(mo), int(d), int(h), int(mi), int(sec or 0))
+def decode_Ybd(m):
+    y, b, d, h, mi, sec = m.groups()
+    return local_epoch(int(y), MONTHS[b], int(d), int(h), int(mi), int(sec or 0))
+def decode_iso8601(m):
+    return calendar.timegm(tuple(map(int, m.groups())))
+def decode_rfc1123(m):
+    d, b, y, h, mi, sec = m.groups()
+    return calendar.timegm((int(y), MONTHS[b], int(d), int(h), int(mi), int(sec)))
+
+def strptime_decoder(fmt, utc=False):
+    """Slow decoder for the rarely used formats."""
+    def decode(m):
+        st = time.strptime(m.group(0), fmt)
+        if utc:
+            return calendar.timegm(st) - (st.tm_gmtoff or 0)
+        return time.mktime(st)
+    return decode
+
+# (regex, decoder returning the epoch timestamp), tried in order until one matches
+DATE_DECODERS = (
+(re.compile(r'(\d+)-([A-S][a-y]{2})-(\d{4}) (\d+):(\d{2})(?::(\d{2}))?'), decode_dbY),
+(re.compile(r'(\d{4})-(\d+)-(\d+) (\d+):(\d{2})(?::(\d{2}))?'), decode_Ymd),
+(re.compile(r'(\d{4})-(\d+)-(\d+)T(\d+):(\d{2}):(\d{2})Z'), decode_iso8601),
+(re.compile(r'(\d{4})-([A-S][a-y]{2})-(\d+) (\d+):(\d{2})(?::(\d{2}))?'), decode_Ybd),
+(re.compile(r'[F-W][a-u]{2} [A-S][a-y]{2} +\d+ \d{2}:\d{2}:\d{2} \d{4}'), strptime_decoder("%a %b %d %H:%M:%S %Y")),
+(re.compile(r'[F-W][a-u]{2}, (\d+) ([A-S][a-y]{2}) (\d{4}) (\d{2}):(\d{2}):(\d{2}) GMT'), decode_rfc1123),
+(re.compile(r'[F-W][a-u]{2}, \d+ [A-S][a-y]{2} \d{4} \d{2}:\d{2}:\d{2} .+'), strptime_decoder("%a, %d %b %Y %H:%M:%S %Z", utc=True)),
+(re.compile(r'\d{4}-\d+-\d+'), strptime_decoder("%Y-%m-%d")),
+(re.compile(r'\d+/\d+/\d{4} \d{2}:\d{2}:\d{2} [+-]\d{4}'), strptime_decoder("%d/%m/%Y %H:%M:%S %z", utc=True)),
+(re.compile(r'\d{2} [A-S][a-y]{2} \d{4}'), strptime_decoder("%d %b %Y"))
 )
 
 RE_FILESIZE = re.compile(r'\d+(\.\d+)? ?[BKMGTPEZY]|\d+|-', re.I)
+SIZE_PREFIXES = {s: 1 << i*10 for i, s in enumerate('BKMGTPEZY')}
 RE_ABSPATH = re.compile(r'^((ht|f)tps?:/)?/')
 RE_COMMONHEAD = re.compile('Name|(Last )?modifi(ed|cation)|date|Size|Description|Metadata|Type|Parent Directory', re.I)
 RE_HASTEXT = re.compile('.+')
@@ -62,6 +96,9 @@ RE_HEAD_SIZE = re.compile('size|bytes$')
 
 FileEntry = collections.namedtuple('FileEntry', 'name modified size description')
 
+# nginx serves JSON or XML listings if configured with autoindex_format; it doesn't look at Accept, but other servers might
+LISTING_ACCEPT = 'application/json, application/xml;q=0.9, text/html;q=0.8, */*;q=0.5'
+
 def human2bytes(s):
     """
     >>> human2bytes('1M')
@@ -74,29 +111,98 @@ def human2bytes(s):
     try:
         return int(s)
     except ValueError:
-        symbols = 'BKMGTPEZY'
         letter = s[-1:].strip().upper()
         num = float(s[:-1])
-        prefix = {symbols[0]: 1}
-        for i, s in enumerate(symbols[1:]):
-            prefix[s] = 1 << (i+1)*10
-        return int(num * prefix[letter])
+        return int(num * SIZE_PREFIXES[letter])
 
 def aherf2filename(a_href):
     isdir = ('/' if a_href[-1] == '/' else '')
     return os.path.basename(urllib.parse.unquote(a_href.rstrip('/'))) + isdir
 
-def parse(soup):
+class ListingDecoder:
+    '''
+    Decodes the date and size columns of one listing.
+
+    A listing uses the same formats in every row, so the formats found in
+    the first row are tried first; the full search only runs again for
+    rows that don't match them.
+    '''
+    def __init__(self):
+        self.date_decoder = None
+        self.plain_sizes = None # True if sizes are given in bytes, False for 12M-style sizes
+
+    def match_date(self, regex, decode, text):
+        match = regex.match(text)
+        if match:
+            try:
+                return decode(match), match.end()
+            except (KeyError, ValueError): # e.g. a month name that isn't one
+                pass
+        return None
+
+    def date(self, text):
+        """Decode the date at the start of text. Returns (epoch timestamp, end of the date) or (None, 0)."""
+        if self.date_decoder:
+            found = self.match_date(*self.date_decoder, text)
+            if found:
+                return found
+        for decoder in DATE_DECODERS:
+            found = self.match_date(*decoder, text)
+            if found:
+                self.date_decoder = decoder
+                return found
+        return None, 0
+
+    def size(self, text):
+        """Decode the size at the start of text. Returns (size in bytes or None, end of the size). The end is 0 if there's no size."""
+        token = text.split(None, 1)[0] if text else ''
+        if self.plain_sizes and token.isdigit():
+            return int(token), len(token)
+        if self.plain_sizes is False and token[-1:] in SIZE_PREFIXES:
+            try:
+                return int(float(token[:-1]) * SIZE_PREFIXES[token[-1]]), len(token)
+            except ValueError:
+                pass
+        match = RE_FILESIZE.match(text)
+        if not match:
+            return None, 0
+        sizestr = match.group(0)
+        if sizestr == '-':
+            return None, match.end()
+        self.plain_sizes = sizestr.isdigit()
+        return human2bytes(sizestr.replace(' ', '').replace(',', '')), match.end()
+
+def parse_pre_line(text, decoder):
+    '''
+    Parse the text that follows a link in a <pre> listing.
+
+    Returns: modification time, size, description (each None if missing)
+    '''
+    file_desc = None
+    line = text.replace('\r', '').split('\n', 1)[0].lstrip()
+    file_mod, end = decoder.date(line)
+    line = line[end:].lstrip()
+    file_size, end = decoder.size(line)
+    line = line[end:].lstrip()
+    if line:
+        file_desc = line.rstrip()
+    return file_mod, file_size, file_desc
+
+def parse(soup, accept_name=None):
     '''
     Try to parse apache/nginx-style directory listing with all kinds of tricks.
 
     Exceptions or an empty listing suggust a failure.
     We strongly recommend generating the `soup` with 'html5lib'.
 
+    If `accept_name` is given, entries whose file name it rejects are
+    skipped before their date and size are parsed.
+
     Returns: Current directory, Directory listing
     '''
     cwd = None
     listing = []
+    decoder = ListingDecoder()
     if soup.title and soup.title.string and soup.title.string.startswith('Index of '):
         cwd = soup.title.string[9:]
     elif soup.h1:
@@ -122,29 +228,19 @@ def parse(soup):
                         listing.append(FileEntry(
                             file_name, file_mod, file_size, file_desc))
                     file_name = aherf2filename(element['href'])
+                    if accept_name and not accept_name(file_name):
+                        file_name = None
                     file_mod = file_size = file_desc = None
                 elif (element.string in ('Parent Directory', '..', '../') or
                       element['href'][0] not in '?/'):
                     started = True
-            elif not element.name:
-                line = element.string.replace('\r', '').split('\n', 1)[0].lstrip()
-                for regex, fmt in DATETIME_FMTs:
-                    match = regex.match(line)
-                    if match:
-                        file_mod = time.strptime(match.group(0), fmt)
-                        line = line[match.end():].lstrip()
-                        break
-                match = RE_FILESIZE.match(line)
-                if match:
-                    sizestr = match.group(0)
-                    if sizestr == '-':
-                        file_size = None
-                    else:
-                        file_size = human2bytes(sizestr.replace(' ', '').replace(',', ''))
-                    line = line[match.end():].lstrip()
-                if line:
-                    file_desc = line.rstrip()
-                    if file_name and file_desc == '/':
+            elif not element.name and file_name:
+                mod, size, desc = parse_pre_line(element.string, decoder)
+                file_mod = mod or file_mod
+                file_size = size if size is not None else file_size
+                if desc:
+                    file_desc = desc
+                    if file_desc == '/':
                         file_name += '/'
                         file_desc = None
             else:
@@ -175,23 +271,22 @@ def parse(soup):
                             break
                         else:
                             file_name = aherf2filename(a_href)
+                            if accept_name and not accept_name(file_name):
+                                file_name = None
+                                break
                             status = 1
                     elif heads[status] == 'modified':
                         if td.time:
-                            timestr = td.time.get('datetime', '')
-                            if RE_ISO8601.match(timestr):
-                                file_mod = time.strptime(timestr, "%Y-%m-%dT%H:%M:%SZ")
+                            file_mod, _ = decoder.date(td.time.get('datetime', ''))
+                            if file_mod is not None:
                                 status += 1
                                 continue
                         timestr = td.get_text().strip()
                         if timestr:
-                            for regex, fmt in DATETIME_FMTs:
-                                if regex.match(timestr):
-                                    file_mod = time.strptime(timestr, fmt)
-                                    break
-                            else:
+                            file_mod, _ = decoder.date(timestr)
+                            if file_mod is None:
                                 if td.get('data-sort-value'):
-                                    file_mod = time.gmtime(int(td['data-sort-value']))
+                                    file_mod = int(td['data-sort-value'])
                                 # else:
                                     # raise AssertionError(
                                         # "can't identify date/time format")
@@ -203,12 +298,7 @@ def parse(soup):
                         elif td.get('data-sort-value'):
                             file_size = int(td['data-sort-value'])
                         else:
-                            match = RE_FILESIZE.match(sizestr)
-                            if match:
-                                file_size = human2bytes(
-                                    match.group(0).replace(' ', ''))
-                            else:
-                                file_size = None
+                            file_size, _ = decoder.size(sizestr)
                         status += 1
                     elif heads[status] == 'description':
                         file_desc = file_desc or ''.join(map(str, td.children)
@@ -261,18 +351,235 @@ def parse(soup):
                 continue
             file_name = urllib.parse.unquote(a['href'])
             if (file_name in {'Parent Directory', '.', './', '..', '../', '#'}
-                or RE_ABSPATH.match(file_name)):
+                or RE_ABSPATH.match(file_name)
+                or (accept_name and not accept_name(file_name))):
                 continue
             else:
                 listing.append(FileEntry(file_name, None, None, None))
     return cwd, listing
 
-def fetch_listing(url, timeout=30):
+def fetch_listing(url, timeout=30, accept_name=None):
     import requests
     req = requests.get(url, timeout=timeout)
     req.raise_for_status()
     soup = bs4.BeautifulSoup(req.content, 'html5lib')
-    return parse(soup)
+    return parse(soup, accept_name)
+
+class ListingStreamParser(HTMLParser):
+    '''
+    Incremental parser for apache/nginx-style <pre> and <table> listings.
+
+    Feed it text as it arrives; parsed FileEntries are appended to
+    `entries`. It is less tolerant than `parse` (e.g. of <ul> listings),
+    so callers should fall back to `parse` if `found` stays 0.
+    '''
+    def __init__(self, accept_name=None):
+        super().__init__(convert_charrefs=True)
+        self.accept_name = accept_name
+        self.decoder = ListingDecoder()
+        self.entries = collections.deque()
+        self.found = 0 # entries produced so far
+        self.in_pre = False
+        self.href = None # set while inside <a>
+        self.a_text = ''
+        self.name = None # <pre> entry waiting for its date and size
+        self.line = ''
+        self.cells = None # texts of the <td>s of the current <tr>
+        self.row_name = None
+
+    def link_name(self):
+        text = self.a_text.strip()
+        href = self.href
+        if (not href or not text or href[0] in '?#' or href in ('.', './', '..', '../')
+            or text in ('Parent Directory', '..', '../') or text.startswith('[To Parent')):
+            return None
+        name = aherf2filename(href)
+        if self.accept_name and not self.accept_name(name):
+            return None
+        return name
+
+    def flush_pre(self):
+        if self.name:
+            file_mod, file_size, file_desc = parse_pre_line(self.line, self.decoder)
+            if file_desc == '/':
+                self.name += '/'
+                file_desc = None
+            self.entries.append(FileEntry(self.name, file_mod, file_size, file_desc))
+            self.found += 1
+        self.name = None
+
+    def flush_row(self):
+        if self.row_name:
+            file_mod = file_size = None
+            cells = [c.strip(' \t\n\r\x0b\x0c\xa0') for c in self.cells]
+            for i, c in enumerate(cells):
+                file_mod, end = self.decoder.date(c)
+                if file_mod is not None and end == len(c):
+                    break
+                file_mod = None
+            for c in cells[i+1:] if file_mod is not None else cells:
+                c = c.replace(',', '')
+                file_size, end = self.decoder.size(c)
+                if file_size is not None and end == len(c):
+                    break
+                file_size = None
+            self.entries.append(FileEntry(self.row_name, file_mod, file_size, None))
+            self.found += 1
+        self.cells = self.row_name = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            self.flush_pre()
+            self.href = dict(attrs).get('href')
+            self.a_text = ''
+        elif tag == 'pre':
+            self.in_pre = True
+        elif tag == 'tr':
+            self.flush_row()
+            self.cells = []
+        elif tag == 'td' and self.cells is not None:
+            self.cells.append('')
+        elif tag == 'th':
+            self.cells = None # header row
+
+    def handle_endtag(self, tag):
+        if tag == 'a' and self.href is not None:
+            name = self.link_name()
+            if self.in_pre:
+                self.name = name
+                self.line = ''
+            elif self.cells is not None and not self.row_name:
+                self.row_name = name
+            self.href = None
+        elif tag == 'pre':
+            self.flush_pre()
+            self.in_pre = False
+        elif tag in ('tr', 'table'):
+            self.flush_row()
+
+    def handle_data(self, data):
+        if self.href is not None:
+            self.a_text += data
+        elif self.in_pre:
+            if self.name:
+                self.line += data
+        elif self.cells:
+            self.cells[-1] += data
+
+def iter_listing(url, timeout=30, accept_name=None, chunk_size=16*1024, session=None):
+    '''
+    Like `fetch_listing`, but yields FileEntries while the listing is
+    still being downloaded. Uses the `requests.Session` if one is given.
+
+    Falls back to `parse` if the incremental parser can't make sense of
+    the page.
+    '''
+    import requests
+    with (session or requests).get(url, headers={'Accept': LISTING_ACCEPT}, timeout=timeout, stream=True) as req:
+        req.raise_for_status()
+        yield from iter_response(req, accept_name, chunk_size)
+
+def listing_format(req):
+    '''
+    Tell the format of a listing from its Content-Type: 'json', 'xml' or
+    'html'.
+    '''
+    ctype = req.headers.get('Content-Type', '').split(';')[0].strip().lower()
+    if ctype == 'application/json' or ctype.endswith('+json'):
+        return 'json'
+    if ctype in ('application/xml', 'text/xml') or ctype.endswith('+xml'):
+        return 'xml'
+    return 'html'
+
+def make_entry(name, is_dir, mtime, size, decoder, accept_name):
+    if not name:
+        return None
+    if is_dir:
+        name += '/'
+    if accept_name and not accept_name(name):
+        return None
+    modified = decoder.date(mtime)[0] if mtime else None
+    return FileEntry(name, modified, int(size) if size is not None else None, None)
+
+def iter_json(chunks, accept_name=None):
+    '''
+    Parse an nginx `autoindex_format json` listing, an array of objects
+    like {"name": ..., "type": "file", "mtime": ..., "size": ...},
+    yielding FileEntries while it arrives.
+    '''
+    decoder = ListingDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    raw = json.JSONDecoder()
+    buf = ''
+    for chunk in chunks:
+        buf += text.decode(chunk)
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,[':
+                pos += 1
+            if pos >= len(buf) or buf[pos] == ']':
+                break
+            try:
+                obj, pos_end = raw.raw_decode(buf, pos)
+            except json.JSONDecodeError: # the object isn't complete yet
+                break
+            pos = pos_end
+            if isinstance(obj, dict):
+                entry = make_entry(obj.get('name'), obj.get('type') == 'directory', obj.get('mtime'), obj.get('size'), decoder, accept_name)
+                if entry:
+                    yield entry
+        buf = buf[pos:]
+
+def iter_xml(chunks, accept_name=None):
+    '''
+    Parse an nginx `autoindex_format xml` listing, <list> of
+    <file mtime=".." size="..">name</file> and <directory> elements,
+    yielding FileEntries while it arrives.
+    '''
+    decoder = ListingDecoder()
+    parser = ET.XMLPullParser(events=('end',))
+    def entries():
+        for _, el in parser.read_events():
+            if el.tag in ('file', 'directory'):
+                entry = make_entry(el.text, el.tag == 'directory', el.get('mtime'), el.get('size'), decoder, accept_name)
+                if entry:
+                    yield entry
+            el.clear()
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from entries()
+    parser.close()
+    yield from entries()
+
+def iter_response(req, accept_name=None, chunk_size=16*1024):
+    '''
+    Parse the listing in a streamed `requests` response, see `iter_listing`.
+    JSON and XML listings are recognized by their Content-Type, anything
+    else is parsed as HTML.
+    '''
+    fmt = listing_format(req)
+    if fmt == 'json':
+        yield from iter_json(req.iter_content(chunk_size), accept_name)
+        return
+    if fmt == 'xml':
+        yield from iter_xml(req.iter_content(chunk_size), accept_name)
+        return
+    received = []
+    parser = ListingStreamParser(accept_name)
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    for chunk in req.iter_content(chunk_size):
+        received.append(chunk)
+        parser.feed(decoder.decode(chunk))
+        while parser.entries:
+            yield parser.entries.popleft()
+    parser.feed(decoder.decode(b'', final=True))
+    parser.close()
+    parser.flush_pre()
+    parser.flush_row()
+    yield from parser.entries
+    if not parser.found: # links outside <pre> and <table>, or no matching files at all
+        soup = bs4.BeautifulSoup(b''.join(received), 'html5lib')
+        yield from parse(soup, accept_name)[1]
 
 if __name__ == '__main__':
     import sys
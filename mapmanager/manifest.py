@@ -0,0 +1,117 @@
+"""
+Machine-readable listing of a maps directory, meant to be served next to the maps.
+
+Unlike an HTML autoindex it contains exact sizes and modification times, and sha256 hashes of both the served files and the extracted maps.
+Format:
+    {"version": 1, "files": [{"name": "zs_foo_v2.bsp.bz2", "size": 123, "mtime": 1540389723.5, "sha256": "...", "bsp_size": 456, "bsp_sha256": "..."}, ...]}
+bsp_size and bsp_sha256 are only present for compressed files in formats this machine can decode.
+"""
+
+import os
+import json
+import hashlib
+
+from mapmanager.mapfiles import read_local_mapinfo, split_extension
+from mapmanager.mapinfo import MapInfo, parse_version
+from mapmanager.formats import COMPRESSED_EXTS, CorruptFile, can_decode, decoder
+
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+
+def hash_file(path, decompressor=None, chunk_size=1024*1024):
+    """Return (sha256 of the file, sha256 and size of the decompressed data). The latter is None if no decompressor (see formats.decoder) is given."""
+    h = hashlib.sha256()
+    h_bsp = hashlib.sha256()
+    bsp_size = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+            if decompressor:
+                data = decompressor.decompress(chunk)
+                h_bsp.update(data)
+                bsp_size += len(data)
+    if decompressor:
+        data = decompressor.flush()
+        h_bsp.update(data)
+        return h.hexdigest(), (h_bsp.hexdigest(), bsp_size + len(data))
+    return h.hexdigest(), None
+
+def manifest_entry(filename, mapsdir, previous=None):
+    """Describe one file. If the previous manifest has an entry with the same size and mtime, it's reused instead of hashing the file again."""
+    m = read_local_mapinfo(filename, mapsdir)
+    if not m:
+        return None
+    if previous and previous['size'] == m.size and previous['mtime'] == m.modified:
+        return previous
+
+    entry = {'name': filename, 'size': m.size, 'mtime': m.modified}
+    decompressor = decoder(m.ext) if m.ext in COMPRESSED_EXTS and can_decode(m.ext) else None
+    try:
+        entry['sha256'], bsp = hash_file(os.path.join(mapsdir, filename), decompressor)
+    except CorruptFile as e:
+        print("{} can't be decoded ({}), listing it without the map's hash".format(filename, e))
+        entry['sha256'], bsp = hash_file(os.path.join(mapsdir, filename))
+    if bsp:
+        entry['bsp_sha256'], entry['bsp_size'] = bsp
+    return entry
+
+def build_manifest(mapsdir, previous=None):
+    """Scan the maps directory and return the manifest as a dict."""
+    old_entries = {e['name']: e for e in previous['files']} if previous else {}
+    files = []
+    for f in sorted(os.listdir(mapsdir)):
+        entry = manifest_entry(f, mapsdir, old_entries.get(f))
+        if entry:
+            files.append(entry)
+    return {'version': MANIFEST_VERSION, 'files': files}
+
+def write_manifest(mapsdir):
+    """(Re)generate the manifest.json file in the maps directory. Returns the number of listed files."""
+    path = os.path.join(mapsdir, MANIFEST_NAME)
+    try:
+        with open(path) as f:
+            previous = json.load(f)
+        if previous.get('version') != MANIFEST_VERSION:
+            previous = None
+    except (FileNotFoundError, ValueError):
+        previous = None
+
+    manifest = build_manifest(mapsdir, previous)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, separators=(',', ':'))
+    os.replace(tmp, path) # never serve a half-written manifest
+    return len(manifest['files'])
+
+def parse_manifest_entry(entry):
+    """Make a MapInfo based on a manifest entry."""
+    rawname, ext = split_extension(entry['name'])
+    if not rawname:
+        return None
+
+    mapname, version = parse_version(rawname)
+    digest = entry.get('bsp_sha256') if ext in COMPRESSED_EXTS else entry.get('sha256')
+    return MapInfo(mapname, version, entry['mtime'], entry['size'], ext, digest, name=entry['name'])
+
+def fetch_manifest(url, timeout=30, filt=None, session=None):
+    """Return the list of MapInfos from the server's manifest.json or None if the server doesn't have one. If a MapFilter is given, only matching maps are returned."""
+    import requests
+    try:
+        req = (session or requests).get(url+MANIFEST_NAME, timeout=timeout)
+    except requests.RequestException: # the manifest is optional, the listing reports real connection problems
+        return None
+    if not req.ok: # 404, or 403 from S3/CDN buckets for missing keys
+        return None
+    try:
+        manifest = req.json()
+    except ValueError: # some servers answer with an HTML error page and status 200
+        return None
+    if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION:
+        return None
+    entries = manifest['files']
+    if filt:
+        entries = [e for e in entries if filt.match_name(e['name']) and filt.match_meta(e['size'], e['mtime'])]
+    return [parse_manifest_entry(e) for e in entries]
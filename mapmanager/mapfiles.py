@@ -3,20 +3,22 @@
 import time
 import os
 import sys
-import bz2
-import tempfile
+import hashlib
 import platform
 import itertools
+import urllib.parse
 
-from urllib.request import urlopen
 from operator import attrgetter
 from collections import namedtuple, defaultdict
 from functools import partial
 
-from mapmanager.htmllistparse import fetch_listing
+from mapmanager.crawler import crawl
+from mapmanager.transfer import download
+from mapmanager.formats import decoder
 from mapmanager.keyvalues import KeyValues
-from mapmanager.mapinfo import MapInfo, parse_version, is_zs_map
+from mapmanager.mapinfo import MapInfo, MapFilter, parse_version
 from mapmanager.meme import filter_none
+from mapmanager.metrics import DECOMPRESS_SECONDS, MAPS_UPGRADED, MAPS_REMOVED, CACHE_LOOKUPS, LISTING_SECONDS, host
 
 gmoddir = 'steamapps/common/GarrysMod/'
 def has_gmod(path):
@@ -49,10 +51,12 @@ def find_gmod():
         else:
             return []
 
-map_exts = ['.bsp.bz2','.bsp']
+map_exts = ['.bsp.bz2','.bsp.xz','.bsp.gz','.bsp']
 def split_extension(filename):
+    """Split the filename into the name and the extension, which is returned lowercase."""
+    folded = filename.lower()
     for e in map_exts:
-        if filename.endswith(e):
+        if folded.endswith(e):
             return filename[:-len(e)], e
     return None, None
 
@@ -72,66 +76,128 @@ def read_local_mapinfo(filename, mapsdir):
     fullpath = os.path.join(mapsdir,filename)
     mtime = os.path.getmtime(fullpath)
     size = os.path.getsize(fullpath)
-    return MapInfo(mapname, version, mtime, size, ext)
-def parse_remote_mapinfo(entry):
-    """Make a MapInfo based on FileEntry metadata."""
+    return MapInfo(mapname, version, mtime, size, ext, name=filename)
+def parse_remote_mapinfo(entry, path=''):
+    """Make a MapInfo based on FileEntry metadata. path is the subdirectory the entry was listed in."""
     rawname, ext = split_extension(entry.name)
     if not rawname:
         return None
     
     mapname, version = parse_version(rawname)
-    mtime = time.mktime(entry.modified)
-    return MapInfo(mapname, version, mtime, entry.size, ext)
-
-def download(url, reporter_class, chunk_size=4096):  #adapted from https://stackoverflow.com/a/2030027
-    """Download data from the url to a temporary file and returns the file object. Also takes a reporter object to use to display progress."""
-    with urlopen(url) as response: #TODO: Error handling!
-        total_size = response.getheader('Content-Length').strip()
-        total_size = int(total_size)
-        reporter = reporter_class(total_size)
-        bytes_so_far = 0
-        tmp = tempfile.TemporaryFile()
-
-        while True: #TODO: Use iterators?
-            chunk = response.read(chunk_size)
-            if not chunk:
-                break
-            bytes_so_far += len(chunk)
-            reporter.report(bytes_so_far)
-
-            tmp.write(chunk)
-
-    sys.stdout.write('\n')
-    return tmp
-
-def extract_to(f, path):
-    """Reads bz2 data from the file object and writes it to the given path."""
-    f.seek(0)
-    decompressor = bz2.BZ2Decompressor()
-    with open(path, 'wb') as f_out:
-        while True:
-            chunk = f.read(1024)
-            if not chunk:
-                break
-            data = decompressor.decompress(chunk)
-            f_out.write(data)
-
-def upgrade(u, url, mapsdir, make_reporter): #TODO: all the operations that need url or mapsdir should probably be methods of a new class
-    """downloads an upgrade and writes it to disk."""
+    return MapInfo(mapname, version, entry.modified, entry.size, ext, path=path, name=entry.name)
+
+class Extractor:
+    """Decodes a map file with the given extension fed to it in order into the given path, so that extraction can run while the download is still arriving."""
+    def __init__(self, path, ext):
+        self.path = path
+        self.ext = ext
+        self.f_out = open(path, 'wb')
+        self.decoder = decoder(ext)
+        self.hash = hashlib.sha256()
+        self.seconds = 0 # spent decoding, for metrics
+
+    def write(self, data):
+        self.hash.update(data)
+        self.f_out.write(data)
+
+    def feed(self, chunk):
+        start = time.perf_counter()
+        self.write(self.decoder.decompress(chunk))
+        self.seconds += time.perf_counter() - start
+
+    def close(self):
+        """Finish the extraction and return the sha256 of the extracted data."""
+        self.write(self.decoder.flush())
+        self.f_out.close()
+        DECOMPRESS_SECONDS.observe(self.seconds, format=self.ext)
+        return self.hash.hexdigest()
+
+    def abort(self):
+        self.f_out.close()
+        os.remove(self.path)
+
+def upgrade(u, url, mapsdir, make_reporter, store=None, hashes=None, state=None, mirrors=(), session=None, staging=None): #TODO: all the operations that need url or mapsdir should probably be methods of a new class
+    """downloads an upgrade and writes it to disk. If a MapStore is given, the map is downloaded only if the store doesn't have it yet and then linked into mapsdir.
+    If a HashCache is given, the hash of the extracted map is recorded in it. If a SyncState is given, the install is recorded in it.
+    mirrors are other urls of the maps directory, used when the download from url stalls. session is a requests.Session for segmented downloads.
+    If a staging directory is given, the map is written there instead of mapsdir, see mapmanager.staging."""
     filename = u.new.filename(False)
-    tmp = download(url+filename+'.bsp.bz2', make_reporter(u.new.mapname))
-    print("decompressing...")
-    extract_to(tmp, os.path.join(mapsdir,filename+'.bsp')) #Assumption: server gives us only compressed maps
-
-def remove_map(mapinfo, mapsdir):
+    dest = os.path.join(staging or mapsdir,filename+'.bsp')
+    remote_name = urllib.parse.quote(u.new.path + u.new.filename()) # the format chosen by the planner, see mapinfo.cheapest_variant
+    source = url+remote_name
+    if state:
+        state.begin_install(filename+'.bsp', source, u.new)
+    digest = store.lookup(u.new) if store else None
+    if store:
+        CACHE_LOOKUPS.inc(cache='store', result='hit' if digest else 'miss')
+    if digest:
+        print("{} - linking from the store".format(u.new.mapname))
+        store.link(digest, dest)
+        MAPS_UPGRADED.inc(source='store')
+    else:
+        extractor = Extractor(store.tempfile() if store else dest+'.part', u.new.ext) # extracted while downloading, so it must not replace a working map before it's complete
+        try:
+            tmp = download(source, make_reporter(u.new.mapname), mirrors=[m+remote_name for m in mirrors], size_hint=u.new.size, sink=extractor.feed, session=session)
+            tmp.close()
+            digest = extractor.close() # raises formats.CorruptFile for a truncated archive, which must not be installed
+        except BaseException:
+            extractor.abort()
+            raise
+        if store:
+            store.link(store.add(extractor.path, u.new, digest), dest)
+        else:
+            os.replace(extractor.path, dest)
+        MAPS_UPGRADED.inc(source='download')
+    if hashes:
+        hashes.record_extracted(filename+'.bsp', digest)
+    if state:
+        state.finish_install(filename+'.bsp', dest)
+    if u.old and u.old.key() == u.new.key() and not staging: # staged renames are cleaned up by clean_outdated after activation
+        remove_renamed(u.old, dest, mapsdir, state)
+
+def remove_renamed(old, dest, mapsdir, state=None):
+    """Remove the local map old if it's the same map as dest with a differently cased name, e.g. after a repair of ZS_Foo_v2.bsp downloaded zs_foo_v2.bsp.
+    On case-insensitive filesystems both names are the same file, which is kept."""
+    old_path = os.path.join(mapsdir, old.filename())
+    if old.filename() != os.path.basename(dest) and os.path.exists(old_path) and not os.path.samefile(old_path, dest):
+        remove_map(old, mapsdir, state)
+
+def state_path(mapsdir, name):
+    """Return the path of a MapManager's own file (caches etc.) kept in the hidden .mapmanager/ subdirectory of mapsdir."""
+    statedir = os.path.join(mapsdir, '.mapmanager')
+    os.makedirs(statedir, exist_ok=True)
+    return os.path.join(statedir, name)
+
+def remove_map(mapinfo, mapsdir, state=None):
     os.remove(os.path.join(mapsdir,mapinfo.filename()))
+    MAPS_REMOVED.inc()
+    if state:
+        state.remove(mapinfo.filename())
 def extract_file(mapinfo, mapsdir):
     print("Sorry, extraction not implemented yet! ({})".format(mapinfo.mapname))
 
-def get_local(mapsdir):
-    localfiles = os.listdir(mapsdir)
-    local_mapinfo = [read_local_mapinfo(f, mapsdir) for f in localfiles]
-    return [x for x in local_mapinfo if x and is_zs_map(x)]# filter out non-zs maps and Nones from non-bsp files
-def get_remote(url):
-    _, listing = fetch_listing(url, timeout=30) #TODO: use HTTP content-length to determine size accurately
-    return [parse_remote_mapinfo(l) for l in listing]
\ No newline at end of file
+def get_local(mapsdir, filt=MapFilter()):
+    """Scan the maps directory. Files rejected by the filter's name checks aren't even stat'ed."""
+    localfiles = [f for f in os.listdir(mapsdir) if filt.match_name(f)]
+    local_mapinfo = filter_none(read_local_mapinfo(f, mapsdir) for f in localfiles) # Nones from non-bsp files
+    return [x for x in local_mapinfo if filt.match_meta(x.size, x.modified)]
+def iter_remote(url, filt=MapFilter(), depth=0, cache=None, session=None):
+    """Yield the server's maps while the listing is still being received. Uses the exact manifest.json if the server provides one and falls back to parsing the HTML listing.
+    Entries rejected by the filter are dropped before they are turned into MapInfos.
+    Subdirectories are searched up to depth levels down, using the ListingCache if given."""
+    from mapmanager.manifest import fetch_manifest # manifest.py imports this module
+    start = time.monotonic()
+    remote_mapinfo = fetch_manifest(url, timeout=30, filt=filt, session=session)
+    if remote_mapinfo is not None:
+        LISTING_SECONDS.observe(time.monotonic() - start, server=host(url))
+        yield from remote_mapinfo
+        return
+    for path, entry in crawl(url, filt.match_name, depth, cache, timeout=30, session=session): #TODO: use HTTP content-length to determine size accurately
+        if filt.minsize and (entry.size is None or entry.size < filt.minsize):
+            continue
+        m = parse_remote_mapinfo(entry, path) # None for non-map files
+        if m and filt.match_meta(m.size, m.modified):
+            yield m
+def get_remote(url, filt=MapFilter(), depth=0, cache=None, session=None):
+    """Fetch the server's list of maps."""
+    return list(iter_remote(url, filt, depth, cache, session))
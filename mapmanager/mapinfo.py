@@ -6,21 +6,27 @@ import re
 import time
 from operator import attrgetter
 from collections import namedtuple, defaultdict
-from mapmanager.meme import inverse_multidict, mapvalues, list_subtract, filter_none
-from dataclasses import dataclass
+from mapmanager.meme import inverse_multidict, mapvalues, filter_none
+from mapmanager.formats import COMPRESSED_EXTS, can_decode
+from dataclasses import dataclass, field, replace
 #MapInfo = namedtuple('MapInfo',['mapname','version','modified','size','ext'])# We *might* want to change this into a class
 
 @dataclass(unsafe_hash=True)
 class MapInfo:
-    """Represents a .bsp or .bsp.bz2 file in the download/maps directory."""
+    """Represents a .bsp or compressed map file (see formats.COMPRESSED_EXTS) in the download/maps directory."""
     mapname: str
     version: str
     modified: int
     size: int
     ext: str
+    digest: str = field(default=None, compare=False) # sha256 of the .bsp, if known (e.g. from a manifest)
+    path: str = field(default='', compare=False) # subdirectory of a remote map relative to the server's maps directory, see crawler.crawl
+    name: str = field(default=None, compare=False) # the exact file name on disk or on the server; ext is always lowercase, the name might not be
 
     def filename(self, withext=True):
         """Recover map filename given a MapInfo"""
+        if self.name:
+            return self.name if withext else self.name[:-len(self.ext)]
         mapname = self.mapname
         if self.version is not None:
             mapname+='_'+self.version
@@ -29,14 +35,22 @@ class MapInfo:
         else:
             return mapname
 
+    def name_key(self):
+        """Identity of the map regardless of the case of its name, ZS_Foo and zs_foo are the same map."""
+        return self.mapname.casefold()
+
+    def key(self):
+        """Identity of the map version regardless of case, see name_key."""
+        return self.name_key(), self.version.casefold() if self.version is not None else None
+
 #note: remote and local sizes will be different since remote files are compressed!
 #also, sizes are approximate since we are just parsing the apache file listing which gives us the size in MBs
 
 def weak_eq_mapinfo(a,b):
-    return a.mapname == b.mapname and a.version == b.version
+    return a.key() == b.key()
 
 # examples                   zs_18       _v2b           _2018           _2018_a2                _a2_3         _v1_5fix  _v1_4fix3
-versionformat = re.compile("(?<!zs)_(?:v?[0-9]+[a-z]?|(?:20[0-9]{2})(?:_[a-z][0-9])?|(?:[a-z][0-9])(?:_[0-9])?)(?:_?fix[0-9]*)?$")
+versionformat = re.compile("(?<!zs)_(?:v?[0-9]+[a-z]?|(?:20[0-9]{2})(?:_[a-z][0-9])?|(?:[a-z][0-9])(?:_[0-9])?)(?:_?fix[0-9]*)?$", re.I)
 # TODO: this regex REALLY needs to go
 # Versions should be extracted with a function that splits a filename to map name and a version object.
 # Ideally, the version class should support comparison.
@@ -50,75 +64,168 @@ def parse_version(mapname):
         mapname_pure = mapname[:version_pos]
         version = mapname[version_pos+1:] # +1 to remove the underscore
         return (mapname_pure, version)
-# TODO: implement case insensitive name comparison while still writing proper file names (mostly for extraction).
-# Solution 1 (preferred): add a filename field to the mapinfo class.
-# Solution 2: case-insensitive dict class
-# Solution 3: make a string class with case-insensitive hashing
+# Names are compared case-insensitively (see MapInfo.key) while MapInfo.name keeps the proper file name for writes and removals.
 
 def bestversion(xs):# TODO: compare by version?
     """Return the MapInfo with newer version (modification date)."""
     return max(xs,key = attrgetter('modified'))
 def newest_versions(listing):
-    """Given a MapInfo list return a dictionary d associating every map name with MapInfo of the newest version of that map."""
-    mapversions = inverse_multidict(attrgetter('mapname'), listing)
+    """Given a MapInfo list return a dictionary d associating every map name key (see MapInfo.name_key) with MapInfo of the newest version of that map."""
+    mapversions = inverse_multidict(MapInfo.name_key, listing)
     return mapvalues(bestversion, mapversions)
 
+def cheapest_variant(xs):
+    """Return the newest version of a map in the smallest format we can decode. Servers often offer the same version in several formats.
+    Returns None if none of the files can be decoded."""
+    decodable = [x for x in xs if can_decode(x.ext)]
+    if not decodable:
+        return None
+    newest = bestversion(decodable)
+    variants = [x for x in decodable if weak_eq_mapinfo(x, newest)]
+    return min(variants, key=lambda x: x.size if x.size is not None else float('inf'))
+def newest_variants(listing):
+    """Like newest_versions, but picks the cheapest download of every map (see cheapest_variant)."""
+    mapversions = inverse_multidict(MapInfo.name_key, listing)
+    return {k: v for k, v in mapvalues(cheapest_variant, mapversions).items() if v is not None}
+
 MapUpgrade = namedtuple('MapUpgrade', ['old', 'new'])
 def make_upgrade(local, remote, x):
-    """Find the map with name x in local and remote and construct an upgrade."""
+    """Find the map with name key x in local and remote and construct an upgrade."""
     r = remote[x]
     l = local[x] if x in local else None
     return MapUpgrade(l,r)
 
-def is_zs_map(mapinfo):
-    mapname = mapinfo.mapname
-    return mapname.startswith('zs_') or mapname.startswith('ze_')
-    
-def should_check(x, mindate, minsize):
-    return x.size >= minsize and x.modified >= mindate and is_zs_map(x)
+DEFAULT_PREFIXES = ('zs_', 'ze_')
+
+@dataclass(frozen=True)
+class MapFilter:
+    """Decides which maps MapManager cares about.
+    Name checks are cheap, so listing parsers and directory scanners call match_name before parsing anything else about the file."""
+    prefixes: tuple = DEFAULT_PREFIXES # an empty prefix matches every map
+    exts: tuple = None # None matches all map extensions
+    minsize: int = 0
+    mindate: float = 0
+    regex: re.Pattern = None
+    folded_prefixes: tuple = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, 'folded_prefixes', tuple(p.casefold() for p in self.prefixes))
+
+    def match_name(self, filename):
+        folded = filename.casefold() # prefixes and extensions match regardless of case, like map names
+        return (folded.startswith(self.folded_prefixes)
+                and (not self.exts or folded.endswith(self.exts))
+                and (not self.regex or self.regex.search(filename) is not None))
+    def match_meta(self, size, modified):
+        return (not self.minsize or (size is not None and size >= self.minsize)) and (not self.mindate or (modified is not None and modified >= self.mindate))
+    def match(self, mapinfo):
+        return self.match_name(mapinfo.filename()) and self.match_meta(mapinfo.size, mapinfo.modified)
+
+    def identity(self):
+        """Return the filter without the size and date limits, i.e. only the checks that decide if a map is ours at all.
+        Orphan detection needs the full listing, so size and date can only be used when looking for upgrades."""
+        return replace(self, minsize=0, mindate=0)
 
 def list_outdated(local, remote):
     """Compare local and remote versions of maps and return a list of possible updates"""
 
-    def is_outdated(mapinfo):
-        mapname = mapinfo.mapname
-        return mapname not in local or local[mapname].modified < remote[mapname].modified
-    return [m.mapname for m in remote.values() if is_outdated(m)] #map(adfsa, filter(is_outdated, remote.values()))
+    def is_outdated(key):
+        return key not in local or local[key].modified < remote[key].modified
+    return [k for k in remote if is_outdated(k)]
 
 def list_orphans(local, remote):
-    return list_subtract(local,remote, weak_eq_mapinfo)
+    """Return the local maps whose version isn't in remote, comparing names case-insensitively."""
+    remote_keys = {m.key() for m in remote}
+    return [m for m in local if m.key() not in remote_keys]
 
-def list_upgrades(local_mapinfo, remote_mapinfo, mindate=0, minsize=0):
-    remote_filtered = [x for x in remote_mapinfo if should_check(x, mindate, minsize)]
+def list_upgrades(local_mapinfo, remote_mapinfo, filt=MapFilter()):
+    remote_filtered = [x for x in remote_mapinfo if filt.match(x)]
     remote_filtered = sorted(remote_filtered, key=attrgetter('modified'), reverse=True)
 
-    fresh_remote = newest_versions(remote_filtered)
+    fresh_remote = newest_variants(remote_filtered)
     fresh_local = newest_versions(local_mapinfo)
     outdated = list_outdated(fresh_local, fresh_remote)
     return [make_upgrade(fresh_local, fresh_remote, x) for x in outdated]
 
+class StreamingPlanner:
+    """Finds upgrades for new maps while the remote listing is still arriving.
+
+    Autoindex listings are sorted by file name, so once an entry that sorts after every name starting with X arrives, all versions of map X are known.
+    Maps that are already present locally are left for list_upgrades. If the listing turns out not to be sorted, nothing more is reported early,
+    but some maps may already have been reported too early; see replan_early."""
+    def __init__(self, local_mapinfo, filt=MapFilter()):
+        self.fresh_local = newest_versions(local_mapinfo)
+        self.filt = filt
+        self.pending = defaultdict(list) # name key -> remote MapInfos that passed the filter
+        self.last = None
+        self.sorted = True
+
+    def feed(self, mapinfo):
+        """Add a remote MapInfo. Returns the list of upgrades that are known to be final now."""
+        filename = mapinfo.filename()
+        if self.last is not None and filename < self.last:
+            self.sorted = False
+            self.pending.clear()
+        self.last = filename
+        if not self.sorted:
+            return []
+
+        ready = []
+        for key in list(self.pending.keys()):
+            # sorts after every file of the map, see the class docstring. Comparing with the lowercase key also covers differently cased
+            # names (ZS_Foo_v2 vs zs_foo_v1): uppercase letters sort before lowercase ones, so they can't come after filename.
+            if not filename.startswith(key) and filename > key:
+                best = cheapest_variant(self.pending.pop(key))
+                if best:
+                    ready.append(MapUpgrade(None, best))
+        if mapinfo.name_key() not in self.fresh_local and self.filt.match(mapinfo):
+            self.pending[mapinfo.name_key()].append(mapinfo)
+        return ready
+
+def replan_early(early, remote_mapinfo, filt=MapFilter()):
+    """Given the upgrades StreamingPlanner reported early, return upgrades from those to the versions the whole remote listing picks.
+    Needed for listings that turned out not to be sorted by name (e.g. sorted by date), where a map can be reported before its newest version arrived.
+    The early download's local date would be newer than the remote date of the real newest version, so list_upgrades would never offer it."""
+    fresh_remote = newest_variants([x for x in remote_mapinfo if filt.match(x)])
+    ret = []
+    for u in early:
+        best = fresh_remote.get(u.new.name_key())
+        if best and best.key() != u.new.key():
+            ret.append(MapUpgrade(u.new, best))
+    return ret
+
+def list_repairs(broken, remote_mapinfo):
+    """Given a list of broken local MapInfos, return upgrades that download the same versions again. Maps that aren't on the server are skipped."""
+    ret = []
+    for b in broken:
+        best = cheapest_variant([r for r in remote_mapinfo if weak_eq_mapinfo(b, r)])
+        if best:
+            ret.append(MapUpgrade(b, best))
+    return ret
+
 def list_extensions(mapinfos):
-    """Returns a nested dict that associates mapname+'_'+version and file extension with the corresponding MapInfo"""
+    """Returns a nested dict that associates the map version key (see MapInfo.key) and file extension with the corresponding MapInfo"""
     ret = defaultdict(dict)# this could probably be somehow merged with multidict (as a nested multidict) but I'm not sure if that's a good idea
     for m in mapinfos:
-        ret[m.filename(False)][m.ext] = m
+        ret[m.key()][m.ext] = m
     return ret
 
 def redundant_bzs(by_ext):
     """Returns a list of MapInfos that point to compressed files that are no longer needed."""
-    def f(x):
-        """returns """
-        if '.bsp' in x:
-            return x.get('.bsp.bz2')
-    return filter_none(map(f,by_ext.values()))
+    return [m for x in by_ext.values() if '.bsp' in x for ext, m in x.items() if ext in COMPRESSED_EXTS]
 
 def list_unextracted(by_ext):
-    """Returns a list of MapInfos that point to compressed files that are no longer needed."""
+    """Returns a list of MapInfos that point to compressed files that haven't been extracted, one per map."""
     def f(x):
-        """returns """
-        if '.bsp.bz2' in x and not '.bsp' in x:
-            return x['.bsp.bz2']
+        """returns the compressed file to extract, preferring formats we can decode"""
+        if not '.bsp' in x:
+            compressed = [x[e] for e in COMPRESSED_EXTS if e in x]
+            return next((m for m in compressed if can_decode(m.ext)), compressed[0] if compressed else None)
     return filter_none(map(f,by_ext.values()))
 
 def list_local_outdated(local):
-    return list_orphans(local, newest_versions(local).values())
\ No newline at end of file
+    """Return the older versions of local maps, and the older of two files of the same version whose names differ only in case."""
+    outdated = list_orphans(local, newest_versions(local).values())
+    copies = inverse_multidict(lambda m: (m.key(), m.ext), local)
+    duplicates = [m for ms in copies.values() for m in ms if m is not bestversion(ms)]
+    return outdated + [m for m in duplicates if m not in outdated]
\ No newline at end of file
@@ -0,0 +1,161 @@
+"""
+Counters and histograms describing a run, for hosts that run MapManager unattended.
+
+Written with --metrics-file as a Prometheus textfile (e.g. for node_exporter's textfile collector) or, if the file name ends with .json, as a JSON summary.
+"""
+
+import os
+import json
+import time
+import bisect
+import threading
+import urllib.parse
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60) # seconds
+THROUGHPUT_BUCKETS = tuple(2**i * 1024 for i in range(6, 17, 2)) # 64 KiB/s to 64 MiB/s
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+class Counter:
+    kind = 'counter'
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+    def summary(self):
+        with self.lock:
+            return [{'labels': dict(key), 'value': value} for key, value in self.values.items()]
+
+class Gauge(Counter):
+    kind = 'gauge'
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[label_key(labels)] = value
+
+class Histogram:
+    kind = 'histogram'
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.values = {} # label key -> [counts per bucket, sum, count]
+
+    def observe(self, value, **labels):
+        key = label_key(labels)
+        with self.lock:
+            counts, total, n = self.values.get(key) or ([0] * len(self.buckets), 0, 0)
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(counts):
+                counts[i] += 1
+            self.values[key] = [counts, total + value, n + 1]
+
+    def samples(self):
+        ret = []
+        with self.lock:
+            for key, (counts, total, n) in self.values.items():
+                cumulative = 0
+                for bound, c in zip(self.buckets, counts):
+                    cumulative += c
+                    ret.append((self.name+'_bucket', key + (('le', bound),), cumulative))
+                ret.append((self.name+'_bucket', key + (('le', '+Inf'),), n))
+                ret.append((self.name+'_sum', key, total))
+                ret.append((self.name+'_count', key, n))
+        return ret
+
+    def summary(self):
+        with self.lock:
+            return [{'labels': dict(key), 'count': n, 'sum': total, 'buckets': dict(zip(map(str, self.buckets), counts))}
+                    for key, (counts, total, n) in self.values.items()]
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def prometheus(self):
+        lines = []
+        for m in self.metrics:
+            lines.append('# HELP {} {}'.format(m.name, m.help))
+            lines.append('# TYPE {} {}'.format(m.name, m.kind))
+            for name, key, value in m.samples():
+                lines.append('{}{} {}'.format(name, format_labels(key), value))
+        return '\n'.join(lines) + '\n'
+
+    def json(self):
+        return json.dumps({m.name: {'type': m.kind, 'help': m.help, 'values': m.summary()} for m in self.metrics}, indent=1)
+
+    def write(self, path):
+        """Write all metrics to path, atomically so that collectors never read a half-written file."""
+        text = self.json() if path.endswith('.json') else self.prometheus()
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+REGISTRY = Registry()
+
+BYTES_DOWNLOADED = REGISTRY.add(Counter('mapmanager_downloaded_bytes_total', "Bytes downloaded, by server"))
+DOWNLOAD_THROUGHPUT = REGISTRY.add(Histogram('mapmanager_download_throughput_bytes_per_second', "Average speed of every map download, by server", THROUGHPUT_BUCKETS))
+DECOMPRESS_SECONDS = REGISTRY.add(Histogram('mapmanager_decompress_seconds', "Time spent decoding every downloaded map, by format"))
+LISTING_SECONDS = REGISTRY.add(Histogram('mapmanager_listing_seconds', "Time to fetch and parse every directory listing, by server"))
+MAPS_UPGRADED = REGISTRY.add(Counter('mapmanager_maps_upgraded_total', "Maps installed, by source (download or store)"))
+MAPS_REMOVED = REGISTRY.add(Counter('mapmanager_maps_removed_total', "Map files removed"))
+CACHE_LOOKUPS = REGISTRY.add(Counter('mapmanager_cache_lookups_total', "Lookups in the map store, listing cache, hash cache and proxy cache, by result"))
+FAILURES = REGISTRY.add(Counter('mapmanager_failures_total', "Retried and failed downloads, stalls and listing errors, by kind and server"))
+PHASE_SECONDS = REGISTRY.add(Gauge('mapmanager_phase_seconds', "Time spent in each phase of the last run, see cli.phase"))
+LAST_RUN = REGISTRY.add(Gauge('mapmanager_last_run_timestamp_seconds', "When the metrics were last written"))
+
+def host(url):
+    return urllib.parse.urlsplit(url).netloc
+
+class MetricsWriter(threading.Thread):
+    """Writes the metrics to path every interval seconds until stopped, and once more when stopped."""
+    def __init__(self, path, interval=0, registry=REGISTRY, before_write=None):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self.before_write = before_write # called to update gauges right before writing
+        self.stopped = threading.Event()
+
+    def write(self):
+        if self.before_write:
+            self.before_write()
+        LAST_RUN.set(time.time())
+        self.registry.write(self.path)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def start(self):
+        if self.interval > 0:
+            super().start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+        self.write()
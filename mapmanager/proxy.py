@@ -0,0 +1,275 @@
+"""
+Caching proxy for LAN parties and offices, so that every map is downloaded from the upstream server once per site instead of once per machine.
+
+    mapmanager -u UPSTREAM_URL -m /srv/mapcache --port 8000 serve
+
+The other machines then sync with -u http://<proxy>:8000/. The proxy lists the upstream maps directory (but not its subdirectories) in nginx's formats,
+downloads a file into the cache directory the first time a client asks for it and streams it to every client asking while the download is running.
+"""
+
+import os
+import time
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from email.utils import formatdate
+
+import requests
+
+from mapmanager.autoindex import FORMATS
+from mapmanager.htmllistparse import iter_listing
+from mapmanager.transfer import pooled_session, record_download, TIMEOUT
+from mapmanager.metrics import CACHE_LOOKUPS, FAILURES, host
+
+LISTING_TTL = 60 # seconds the upstream listing is reused for
+CHUNK_SIZE = 64*1024
+
+class Fetch:
+    """A download from upstream into the cache that any number of clients can read while it's running."""
+    def __init__(self, path):
+        self.path = path # the cached file once complete
+        self.part = path + '.part'
+        self.cond = threading.Condition()
+        self.size = None # known once upstream answers
+        self.received = 0
+        self.done = False
+        self.error = None
+
+    def wait_for(self, pos):
+        """Wait until there is data after pos or the download ended. Returns the number of bytes received so far."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.received > pos or self.done)
+            return self.received
+
+class CachingProxy:
+    def __init__(self, upstream, cache_dir, listing_ttl=LISTING_TTL):
+        self.upstream = upstream
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.listing_ttl = listing_ttl
+        self.http = pooled_session()
+        self.lock = threading.Lock()
+        self.fetches = {} # file name -> running Fetch
+        self.listing_lock = threading.Lock()
+        self.entries = None # file name -> upstream FileEntry, None if upstream was never reachable
+        self.listed_at = 0
+
+    def upstream_listing(self):
+        """Return the upstream files by name. If upstream can't be reached, the last known listing is used."""
+        with self.listing_lock:
+            if time.monotonic() - self.listed_at > self.listing_ttl:
+                try:
+                    self.entries = {e.name: e for e in iter_listing(self.upstream, TIMEOUT, session=self.http) if not e.name.endswith('/')}
+                except requests.RequestException as e:
+                    print("Couldn't list {}: {}".format(self.upstream, e))
+                    FAILURES.inc(kind='listing', server=host(self.upstream))
+                self.listed_at = time.monotonic()
+            return self.entries
+
+    def is_fresh(self, path, entry):
+        """Check if the cached file is the one upstream has now. Cached files get the upstream date, which changes when the file is replaced."""
+        return entry.modified is None or int(os.path.getmtime(path)) == int(entry.modified)
+
+    def cached_path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def listing(self):
+        """Return (name, mtime, size) of the files to list: the upstream ones, with exact sizes if cached, or all cached files if upstream is unreachable."""
+        upstream = self.upstream_listing()
+        if upstream is None:
+            ret = []
+            for name in os.listdir(self.cache_dir):
+                path = self.cached_path(name)
+                if os.path.isfile(path) and not name.endswith('.part'):
+                    ret.append((name, os.path.getmtime(path), os.path.getsize(path)))
+            return sorted(ret)
+        ret = []
+        for name, e in sorted(upstream.items()):
+            path = self.cached_path(name)
+            if os.path.isfile(path) and self.is_fresh(path, e):
+                ret.append((name, os.path.getmtime(path), os.path.getsize(path)))
+            else:
+                ret.append((name, e.modified or time.time(), e.size or 0))
+        return ret
+
+    def open(self, name):
+        """Return the path of the cached file, a Fetch of it or None if there's no such file."""
+        if name.endswith('.part'):
+            return None
+        upstream = self.upstream_listing()
+        entry = upstream.get(name) if upstream is not None else None
+        path = self.cached_path(name)
+        if os.path.isfile(path) and (upstream is None or entry and self.is_fresh(path, entry)):
+            CACHE_LOOKUPS.inc(cache='proxy', result='hit')
+            return path
+        if entry is None:
+            return None
+        CACHE_LOOKUPS.inc(cache='proxy', result='miss')
+        return self.fetch(name, entry)
+
+    def fetch(self, name, entry):
+        """Start downloading the file from upstream, unless it's already being downloaded. Returns the Fetch."""
+        with self.lock:
+            fetch = self.fetches.get(name)
+            if not fetch:
+                fetch = self.fetches[name] = Fetch(self.cached_path(name))
+                threading.Thread(target=self.run_fetch, args=(name, entry, fetch), daemon=True).start() # not in the handler's thread, so the download goes on if the first client leaves
+        return fetch
+
+    def run_fetch(self, name, entry, fetch):
+        url = self.upstream + urllib.parse.quote(name)
+        print("Fetching {} from upstream".format(name))
+        start = time.monotonic()
+        try:
+            with self.http.get(url, timeout=TIMEOUT, stream=True) as req:
+                req.raise_for_status()
+                with open(fetch.part, 'wb') as f:
+                    with fetch.cond: # once the file exists
+                        fetch.size = int(req.headers['Content-Length']) if 'Content-Length' in req.headers else None
+                        fetch.cond.notify_all()
+                    for chunk in req.iter_content(CHUNK_SIZE):
+                        f.write(chunk)
+                        f.flush() # readers read the file, not the chunks
+                        with fetch.cond:
+                            fetch.received += len(chunk)
+                            fetch.cond.notify_all()
+            if entry.modified:
+                os.utime(fetch.part, (entry.modified, entry.modified))
+            os.replace(fetch.part, fetch.path)
+            record_download(url, fetch.received, start)
+        except (requests.RequestException, OSError) as e:
+            print("Couldn't fetch {}: {}".format(url, e))
+            FAILURES.inc(kind='download', server=host(url))
+            fetch.error = e
+            if os.path.exists(fetch.part):
+                os.remove(fetch.part)
+        finally:
+            with fetch.cond:
+                fetch.done = True
+                fetch.cond.notify_all()
+            with self.lock:
+                del self.fetches[name]
+
+def parse_range(header, size):
+    """Return (start, end) of a single 'bytes=' range, None if there's no such range or False if it can't be satisfied."""
+    if not header.startswith('bytes=') or ',' in header: # multiple ranges get the whole file
+        return None
+    first, _, last = header[len('bytes='):].partition('-')
+    try:
+        if not first: # suffix range: the last bytes
+            start, end = max(size - int(last), 0), size
+        else:
+            start, end = int(first), min(int(last)+1, size) if last else size
+    except ValueError:
+        return None
+    if start >= end:
+        return False
+    return start, end
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self, body=True):
+        proxy = self.server.proxy
+        name = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path).lstrip('/')
+        if not name:
+            return self.send_listing(proxy.listing(), body)
+        if '/' in name or name.startswith('.'):
+            return self.send_error(404)
+        source = proxy.open(name)
+        if source is None:
+            return self.send_error(404)
+        if isinstance(source, Fetch):
+            self.send_fetch(source, body)
+        else:
+            self.send_cached(source, body)
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def send_listing(self, entries, body=True):
+        accept = self.headers.get('Accept', '')
+        fmt = 'json' if 'application/json' in accept else 'xml' if 'xml' in accept else 'html' # clients tell their preference the way htmllistparse.LISTING_ACCEPT does
+        render, content_type = FORMATS[fmt]
+        page = render('/', entries)
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(page)))
+        self.end_headers()
+        if body:
+            self.wfile.write(page)
+
+    def send_headers(self, size, mtime=None):
+        """Send the headers for the requested part of a file of size bytes. Returns the (start, end) to send or None if the range can't be satisfied."""
+        byte_range = parse_range(self.headers.get('Range', ''), size)
+        if byte_range is False:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */{}'.format(size))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        start, end = byte_range or (0, size)
+        self.send_response(206 if byte_range else 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        if mtime:
+            self.send_header('Last-Modified', formatdate(mtime, usegmt=True))
+        if byte_range:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end-1, size))
+        self.end_headers()
+        return start, end
+
+    def send_cached(self, path, body=True):
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            byte_range = self.send_headers(st.st_size, st.st_mtime)
+            if byte_range and body:
+                start, end = byte_range
+                self.wfile.flush()
+                self.connection.sendfile(f, start, end - start) # sendfile(2) where available
+
+    def send_fetch(self, fetch, body=True):
+        """Stream the file to the client while it's being downloaded."""
+        with fetch.cond:
+            fetch.cond.wait_for(lambda: fetch.size is not None or fetch.done)
+        if fetch.size is None: # no Content-Length from upstream, or the download failed; serve it once it's complete
+            fetch.wait_for(float('inf'))
+        try:
+            f = open(fetch.part, 'rb') # opened before the download ends, so the rename into the cache doesn't matter
+        except FileNotFoundError: # already renamed, or removed after an error
+            f = None
+        if f is None or fetch.size is None:
+            if fetch.error:
+                return self.send_error(502)
+            return self.send_cached(fetch.path, body)
+        with f:
+            byte_range = self.send_headers(fetch.size)
+            if not byte_range or not body:
+                return
+            pos, end = byte_range
+            self.wfile.flush()
+            while pos < end:
+                received = fetch.wait_for(pos)
+                if received <= pos: # the download failed; the client will retry with a range
+                    self.close_connection = True
+                    return
+                count = min(received, end) - pos
+                self.connection.sendfile(f, pos, count)
+                pos += count
+
+def serve(upstream, cache_dir, port):
+    """Run the caching proxy until interrupted."""
+    os.makedirs(cache_dir, exist_ok=True)
+    server = ThreadingHTTPServer(('', port), ProxyHandler)
+    server.daemon_threads = True
+    server.proxy = CachingProxy(upstream, cache_dir)
+    print("Serving {} on port {}, fetching from {}".format(cache_dir, port, upstream))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,143 @@
+"""
+Python API for programs that sync maps themselves (server panels, launchers...) instead of running the command line tool.
+
+    with MapSyncSession(url, MapFilter(prefixes=('zs_',))) as session:
+        plan = session.plan(mapsdir)
+        session.apply(plan, progress=lambda m, done, total: ...)
+"""
+
+from dataclasses import dataclass, field
+from functools import partial
+
+from mapmanager.mapfiles import get_local, get_remote, upgrade, remove_map, state_path
+from mapmanager.mapinfo import MapFilter, list_orphans, list_upgrades, list_extensions, redundant_bzs, list_local_outdated
+from mapmanager.state import SyncState
+from mapmanager.verify import HashCache
+from mapmanager.diskspace import SpaceBudget
+from mapmanager.transfer import pooled_session
+
+@dataclass
+class SyncPlan:
+    """What syncing a maps directory would do. upgrades are MapUpgrades, the rest are local MapInfos to remove."""
+    mapsdir: str
+    upgrades: list = field(default_factory=list)
+    orphans: list = field(default_factory=list)
+    outdated: list = field(default_factory=list)
+    redundant: list = field(default_factory=list)
+
+    def removals(self):
+        """All the maps to remove, each one once (an orphan can be outdated too)."""
+        seen = set()
+        ret = []
+        for m in self.orphans + self.outdated + self.redundant:
+            if m.filename() not in seen:
+                seen.add(m.filename())
+                ret.append(m)
+        return ret
+
+    def download_size(self):
+        return sum(u.new.size for u in self.upgrades)
+
+class ProgressReporter:
+    """Passes the download progress of an upgrade to callback(upgrade, bytes_so_far, total_size)."""
+    def __init__(self, upgrade, callback, total_size):
+        self.upgrade = upgrade
+        self.callback = callback
+        self.total_size = total_size
+
+    def report(self, bytes_so_far):
+        self.callback(self.upgrade, bytes_so_far, self.total_size)
+
+def ignore_progress(upgrade, bytes_so_far, total_size):
+    pass
+
+class MapSyncSession:
+    """Syncs maps directories with the server at url. Keeps the HTTP connections, the remote listing and the scans of the maps directories between calls,
+    so that planning several directories, or planning again after apply, doesn't fetch or scan anything twice.
+    store, mirrors, reserve, depth and managed_only work like the command line options of the same names; subdirectory listings are cached in listing_cache if given."""
+    def __init__(self, url, filt=MapFilter(), store=None, mirrors=(), reserve=0, depth=0, managed_only=False, listing_cache=None):
+        self.url = url
+        self.filt = filt
+        self.store = store
+        self.mirrors = list(mirrors)
+        self.reserve = reserve
+        self.depth = depth
+        self.managed_only = managed_only
+        self.http = pooled_session()
+        self.remote = None
+        self.local = {} # mapsdir -> local MapInfos
+        self.states = {}
+        self.hashes = {}
+        self.listing_cache = listing_cache
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.http.close()
+
+    def state(self, mapsdir):
+        if mapsdir not in self.states:
+            self.states[mapsdir] = SyncState(state_path(mapsdir, 'state.sqlite3'))
+        return self.states[mapsdir]
+
+    def hash_cache(self, mapsdir):
+        if mapsdir not in self.hashes:
+            self.hashes[mapsdir] = HashCache(state_path(mapsdir, 'hashes.json'))
+        return self.hashes[mapsdir]
+
+    def remote_maps(self, refresh=False):
+        """Return the server's maps, fetching the listing on the first call or if refresh is set."""
+        if self.remote is None or refresh:
+            self.remote = get_remote(self.url, self.filt.identity(), self.depth, self.listing_cache, self.http) # size and date limits apply only to upgrades, see MapFilter.identity
+        return self.remote
+
+    def local_maps(self, mapsdir, refresh=False):
+        """Return the maps in mapsdir, leaving out interrupted downloads. The directory is scanned again after apply or if refresh is set."""
+        if mapsdir not in self.local or refresh:
+            state = self.state(mapsdir)
+            self.local[mapsdir] = [m for m in get_local(mapsdir, self.filt.identity()) if not state.is_incomplete(m)]
+        return self.local[mapsdir]
+
+    def plan(self, mapsdir):
+        """Compare mapsdir with the server and return a SyncPlan. Nothing is changed on disk."""
+        local = self.local_maps(mapsdir)
+        remote = self.remote_maps()
+        state = self.state(mapsdir)
+        changed_remote = state.changed_remote(local, remote)
+        return SyncPlan(
+            mapsdir=mapsdir,
+            upgrades=list_upgrades(local, changed_remote, self.filt),
+            orphans=[m for m in list_orphans(local, remote) if not self.managed_only or state.is_managed(m)],
+            outdated=list_local_outdated(local),
+            redundant=redundant_bzs(list_extensions(local)),
+        )
+
+    def apply(self, plan, progress=None, done=None):
+        """Remove the plan's maps and then download its upgrades, as many as fit above the reserved free space.
+        progress(upgrade, bytes_so_far, total_size) is called while a map downloads and done(item) after every removed MapInfo and finished MapUpgrade.
+        Returns the upgrades that were postponed for lack of disk space. Pass a plan with only some of the lists filled to do only part of the sync."""
+        mapsdir = plan.mapsdir
+        state = self.state(mapsdir)
+        progress = progress or ignore_progress
+        try:
+            for m in plan.removals():
+                remove_map(m, mapsdir, state)
+                if done:
+                    done(m)
+            def do_upgrade(u):
+                make_reporter = lambda name: partial(ProgressReporter, u, progress)
+                upgrade(u, self.url, mapsdir, make_reporter, self.store, self.hash_cache(mapsdir), state, self.mirrors, self.http)
+                if done:
+                    done(u)
+            budget = SpaceBudget(self.store.root if self.store else mapsdir, self.reserve)
+            return budget.run(plan.upgrades, do_upgrade)
+        finally:
+            self.local.pop(mapsdir, None)
+
+    def gc(self):
+        """Remove maps that aren't linked into any maps directory from the store. Returns the freed space."""
+        return self.store.gc() if self.store else 0
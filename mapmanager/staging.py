@@ -0,0 +1,49 @@
+"""
+Staged updates for machines where the game is running: maps are downloaded into a staging directory in the background and moved into the maps directory at once by the activate operation.
+
+The staging directory is .mapmanager/staging/ inside the maps directory, so activating is only a rename on the same filesystem.
+"""
+
+import os
+import sys
+import shutil
+import subprocess
+
+from mapmanager.mapfiles import state_path
+
+NICENESS = 10
+PROCESS_MODE_BACKGROUND_BEGIN = 0x00100000 # from winbase.h, lowers the CPU, I/O and memory priority
+
+def staging_dir(mapsdir):
+    path = state_path(mapsdir, 'staging')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def lower_priority():
+    """Run the rest of this process at background CPU and I/O priority, so that downloads and extractions don't compete with the game.
+    Must be called before starting threads, since on Linux they inherit the I/O priority of the thread that starts them."""
+    if sys.platform == 'win32':
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        kernel32.SetPriorityClass(kernel32.GetCurrentProcess(), PROCESS_MODE_BACKGROUND_BEGIN)
+        return
+    os.nice(NICENESS)
+    ionice = shutil.which('ionice') # Linux only; elsewhere the niceness also lowers the I/O priority
+    if ionice:
+        subprocess.run([ionice, '-c', '3', '-p', str(os.getpid())], check=False) # idle class: disk access only when nobody else needs it
+
+def activate(mapsdir, store=None):
+    """Move the completed maps from the staging directory into mapsdir and return their file names.
+    Unfinished extractions (.part files) are left in the staging directory."""
+    staging = staging_dir(mapsdir)
+    moved = []
+    for f in sorted(os.listdir(staging)):
+        if not f.endswith('.bsp'):
+            continue
+        src = os.path.join(staging, f)
+        dest = os.path.join(mapsdir, f)
+        os.replace(src, dest)
+        if store:
+            store.moved(src, dest)
+        moved.append(f)
+    return moved
@@ -0,0 +1,77 @@
+"""
+Persistent record of the maps installed by MapManager, kept in an SQLite database in every maps directory.
+"""
+
+import os
+import time
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    filename TEXT PRIMARY KEY,          -- name of the extracted map in the maps directory
+    source_url TEXT NOT NULL,           -- where it was downloaded from
+    remote_modified REAL NOT NULL,      -- modification date and size of the remote file
+    remote_size INTEGER NOT NULL,
+    local_modified REAL,                -- mtime and size of the extracted map, NULL until the install is complete
+    local_size INTEGER,
+    installed_at REAL NOT NULL,
+    complete INTEGER NOT NULL DEFAULT 0
+)
+"""
+
+class SyncState:
+    def __init__(self, path):
+        # check_same_thread=False: early downloads (see cli.get_remote_upgrading) run in a worker thread, but never concurrently with the main thread's writes
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.db:
+            self.db.execute(SCHEMA)
+        self.rows = None
+
+    def all(self):
+        """Return a dict associating filenames with their rows. Loaded once per planning, so that lookups are O(1)."""
+        if self.rows is None:
+            self.rows = {r['filename']: r for r in self.db.execute("SELECT * FROM files")}
+        return self.rows
+
+    def begin_install(self, filename, source_url, remote):
+        """Record that the download of a map has started. Until finish_install, the local file is considered incomplete."""
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO files (filename, source_url, remote_modified, remote_size, installed_at, complete) VALUES (?, ?, ?, ?, ?, 0)",
+                            (filename, source_url, remote.modified, remote.size, time.time()))
+        self.rows = None
+
+    def finish_install(self, filename, path):
+        st = os.stat(path)
+        with self.db:
+            self.db.execute("UPDATE files SET local_modified = ?, local_size = ?, installed_at = ?, complete = 1 WHERE filename = ?",
+                            (st.st_mtime, st.st_size, time.time(), filename))
+        self.rows = None
+
+    def remove(self, filename):
+        with self.db:
+            self.db.execute("DELETE FROM files WHERE filename = ?", (filename,))
+        self.rows = None
+
+    def is_managed(self, mapinfo):
+        """Check if the local map was installed by MapManager."""
+        return mapinfo.filename() in self.all()
+
+    def is_incomplete(self, mapinfo):
+        """Check if the local map is left over from an interrupted download or extraction."""
+        row = self.all().get(mapinfo.filename())
+        return row is not None and not row['complete']
+
+    def is_unchanged(self, remote, local_by_name):
+        """Check if the remote map is the one we installed and the local file wasn't touched since."""
+        filename = remote.filename(False)+'.bsp'
+        row = self.all().get(filename)
+        local = local_by_name.get(filename)
+        return (row is not None and row['complete'] and local is not None
+                and row['remote_modified'] == remote.modified and row['remote_size'] == remote.size
+                and row['local_modified'] == local.modified and row['local_size'] == local.size)
+
+    def changed_remote(self, local_mapinfo, remote_mapinfo):
+        """Return the remote maps that aren't already installed exactly as they are now, so that planning only looks at the changes."""
+        local_by_name = {m.filename(): m for m in local_mapinfo}
+        return [r for r in remote_mapinfo if not self.is_unchanged(r, local_by_name)]
@@ -0,0 +1,236 @@
+"""
+Content-addressed map store shared between several maps/ directories.
+
+Every map version is downloaded and extracted once into the store and then linked into each maps directory.
+Layout of the store directory:
+    objects/<first 2 hex digits>/<sha256 of the .bsp>   the extracted maps
+    index.json                                          which remote file produced which blob and where the blobs are linked
+    index.lock                                          held while index.json is read and written, see MapStore.locked
+"""
+
+import os
+import json
+import errno
+import shutil
+import hashlib
+import platform
+import tempfile
+import time
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+    import msvcrt
+
+FICLONE = 0x40049409 # from linux/fs.h
+GC_GRACE = 60*60 # seconds a blob stays reserved for a link, see MapStore.reserve
+
+def lock_file(f):
+    """Take an exclusive lock on the open file, waiting for other processes to release it."""
+    if fcntl:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    else:
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError: # LK_LOCK gives up after 10 seconds
+                pass
+
+def unlock_file(f):
+    if fcntl:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+def file_digest(path, chunk_size=1024*1024):
+    """Return the hex sha256 of the file at path."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+def version_key(mapinfo):
+    """Identify a remote file. If the server replaces the file, the modification date and size change too."""
+    return "{}|{}|{}".format(mapinfo.filename(), int(mapinfo.modified), mapinfo.size)
+
+def reflink(src, dst):
+    """Make a copy-on-write clone of src (btrfs, xfs). Raises OSError if the filesystem can't do it."""
+    if platform.system() != 'Linux':
+        raise OSError(errno.EOPNOTSUPP, "reflinks are only supported on Linux")
+    with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+        try:
+            fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+        except OSError:
+            f_dst.close()
+            os.remove(dst)
+            raise
+
+class MapStore:
+    def __init__(self, root):
+        self.root = root
+        self.objects = os.path.join(root, 'objects')
+        self.index_path = os.path.join(root, 'index.json')
+        self.lock_path = os.path.join(root, 'index.lock')
+        os.makedirs(self.objects, exist_ok=True)
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        except FileNotFoundError:
+            self.index = {'versions': {}, 'refs': {}}
+        self.index.setdefault('pending', {})
+
+    def save(self):
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp, self.index_path)
+
+    @contextmanager
+    def locked(self):
+        """Hold the store's lock file and re-read the index, so that runs sharing the store (e.g. one cron job per server) see each other's changes.
+        Not reentrant."""
+        with open(self.lock_path, 'a+b') as f:
+            lock_file(f)
+            try:
+                self.load()
+                yield self.index
+            finally:
+                unlock_file(f)
+
+    def blob_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def find(self, mapinfo):
+        digest = mapinfo.digest or self.index['versions'].get(version_key(mapinfo))
+        if digest and os.path.exists(self.blob_path(digest)):
+            return digest
+        return None
+
+    def reserve(self, digest):
+        """Keep gc from removing the blob until it's linked (or GC_GRACE passes, e.g. after a failed run). Call with the lock held."""
+        self.index['pending'][digest] = time.time()
+
+    def lookup(self, mapinfo):
+        """Return the digest of an already stored remote map or None if it has to be downloaded. The blob is reserved for the following link."""
+        with self.locked():
+            digest = self.find(mapinfo)
+            if digest:
+                self.reserve(digest)
+                self.save()
+            return digest
+
+    def tempfile(self):
+        """Return a path for extracting a new map. It's inside the store, so moving it to objects/ is just a rename."""
+        fd, path = tempfile.mkstemp(dir=self.root, suffix='.bsp.part')
+        os.close(fd)
+        os.chmod(path, 0o644) # mkstemp creates files readable only by the owner
+        return path
+
+    def add(self, path, mapinfo, digest=None):
+        """Move the extracted map at path into the store and return its digest. The digest is computed if not given."""
+        digest = digest or file_digest(path)
+        blob = self.blob_path(digest)
+        with self.locked():
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            if os.path.exists(blob): # same content under a different name or date
+                os.remove(path)
+            else:
+                os.replace(path, blob)
+            self.index['versions'][version_key(mapinfo)] = digest
+            self.reserve(digest)
+            self.save()
+        return digest
+
+    def link(self, digest, dest):
+        """Make dest point to the blob. Falls back to a reflink and then to a plain copy if hardlinks are not possible (e.g. different filesystems)."""
+        blob = self.blob_path(digest)
+        tmp = dest + '.part'
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        with self.locked():
+            try:
+                os.link(blob, tmp)
+                kind = 'link'
+            except OSError:
+                try:
+                    reflink(blob, tmp)
+                except OSError:
+                    shutil.copyfile(blob, tmp)
+                kind = 'copy'
+            os.replace(tmp, dest)
+            self.index['refs'].setdefault(digest, {})[os.path.abspath(dest)] = kind
+            self.index['pending'].pop(digest, None)
+            self.save()
+
+    def discard_damaged(self, mapinfo, path):
+        """Forget the stored version of the remote map if the damaged map at path is a hardlink to its blob, so that repairing the map downloads it again."""
+        with self.locked():
+            digest = self.find(mapinfo)
+            if not digest:
+                return
+            blob = self.blob_path(digest)
+            try:
+                if not os.path.samefile(path, blob):
+                    return # a copy; the blob itself is fine
+            except OSError:
+                return
+            os.remove(blob)
+            versions = self.index['versions']
+            for key in [k for k, d in versions.items() if d == digest]:
+                del versions[key]
+            self.index['refs'].pop(digest, None)
+            self.save()
+
+    def moved(self, src, dest):
+        """Record that a linked map was renamed from src to dest, so that gc doesn't consider its blob unused."""
+        src = os.path.abspath(src)
+        with self.locked():
+            for refs in self.index['refs'].values():
+                if src in refs:
+                    refs[os.path.abspath(dest)] = refs.pop(src)
+                    self.save()
+                    return
+
+    def is_referenced(self, digest, path, kind):
+        blob = self.blob_path(digest)
+        try:
+            if kind == 'link':
+                return os.path.samefile(path, blob)
+            return os.path.getsize(path) == os.path.getsize(blob)
+        except OSError:
+            return False
+
+    def gc(self):
+        """Remove the blobs that aren't linked into any maps directory anymore and weren't just added or looked up by a running sync. Returns the number of freed bytes."""
+        freed = 0
+        with self.locked():
+            refs = self.index['refs']
+            for digest in list(refs.keys()):
+                alive = {p: k for p, k in refs[digest].items() if self.is_referenced(digest, p, k)}
+                if alive:
+                    refs[digest] = alive
+                else:
+                    del refs[digest]
+            now = time.time()
+            pending = self.index['pending'] = {d: t for d, t in self.index['pending'].items() if now - t < GC_GRACE}
+            for prefix in os.listdir(self.objects):
+                subdir = os.path.join(self.objects, prefix)
+                for digest in os.listdir(subdir):
+                    if digest not in refs and digest not in pending:
+                        blob = os.path.join(subdir, digest)
+                        freed += os.path.getsize(blob)
+                        os.remove(blob)
+            self.index['versions'] = {k: d for k, d in self.index['versions'].items() if d in refs or d in pending}
+            self.save()
+        return freed
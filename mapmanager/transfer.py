@@ -0,0 +1,345 @@
+"""
+Robust HTTP downloads: stall detection, hedged requests and retries.
+
+A download is done by one or more legs, each fetching the file from some offset to the end in its own thread.
+If the throughput of the current leg drops below a minimum for a whole window, a hedged leg requests the remaining byte range again (from a mirror if there is one).
+If the hedge stalls too, the attempt is given up and retried.
+Whichever leg finishes first wins. Transient errors are retried with exponential backoff, resuming where the download stopped if the server supports ranges.
+
+Files of at least SEGMENT_THRESHOLD bytes are instead split into pieces fetched in parallel over a pool of keep-alive connections, since servers often limit the throughput of a single connection.
+"""
+
+import sys
+import time
+import random
+import socket
+import tempfile
+import contextlib
+import threading
+import http.client
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.request import urlopen, Request
+from urllib.error import URLError, HTTPError
+
+import requests
+
+from mapmanager.metrics import BYTES_DOWNLOADED, DOWNLOAD_THROUGHPUT, FAILURES, host
+
+MIN_RATE = 20 * 1024 # bytes/s; slower legs are considered stalled
+STALL_WINDOW = 15 # seconds
+POLL_INTERVAL = 0.25
+RETRIES = 5
+BACKOFF_BASE = 2 # seconds, doubled on every retry
+TIMEOUT = 30 # seconds without any data before a read fails
+SEGMENT_THRESHOLD = 64 * 1024 * 1024 # smaller files are downloaded over a single connection
+CONNECTIONS = 4
+PIECE_SIZE = 8 * 1024 * 1024
+
+def is_transient(e):
+    if isinstance(e, HTTPError):
+        return e.code >= 500 or e.code == 429
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and (e.response.status_code >= 500 or e.response.status_code == 429)
+    return isinstance(e, (URLError, socket.timeout, ConnectionError, http.client.HTTPException,
+                          requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError))
+
+def backoff(attempt):
+    return BACKOFF_BASE * 2**attempt * random.uniform(0.5, 1.5)
+
+class ThroughputMonitor:
+    """Throughput of a leg over a sliding window. The leg's thread calls add, the downloader's thread calls stalled."""
+    def __init__(self, window=STALL_WINDOW):
+        self.window = window
+        self.samples = deque([(time.monotonic(), 0)])
+
+    def add(self, total_bytes):
+        self.samples.append((time.monotonic(), total_bytes))
+
+    def stalled(self, min_rate=MIN_RATE):
+        """Check if less than min_rate bytes/s arrived during the last window. A connection that sends nothing at all is stalled too."""
+        now = time.monotonic()
+        if now - self.samples[0][0] < self.window:
+            return False
+        while len(self.samples) > 1 and self.samples[1][0] <= now - self.window:
+            self.samples.popleft() # keep the last sample from before the window as its start
+        t0, b0 = self.samples[0]
+        return (self.samples[-1][1] - b0) / (now - t0) < min_rate
+
+class Leg(threading.Thread):
+    """Fetches url from the byte offset start to the end into its own temporary file."""
+    def __init__(self, url, start, finished, timeout=TIMEOUT, chunk_size=64*1024):
+        super().__init__(daemon=True)
+        self.finished = finished # set when the leg is done or failed
+        self.url = url
+        self.start_offset = start
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.file = tempfile.TemporaryFile()
+        self.lock = threading.Lock()
+        self.written = 0
+        self.total = None # size of the whole file, known after the response headers arrive
+        self.ranges = False # whether the server supports Range requests
+        self.done = False
+        self.cancelled = False
+        self.error = None
+        self.monitor = ThroughputMonitor()
+
+    def run(self):
+        try:
+            headers = {'Range': 'bytes={}-'.format(self.start_offset)} if self.start_offset else {}
+            with urlopen(Request(self.url, headers=headers), timeout=self.timeout) as response:
+                self.ranges = response.status == 206 or response.getheader('Accept-Ranges', '') == 'bytes'
+                skip = self.start_offset if response.status != 206 else 0 # the server ignored the Range header
+                self.total = self.start_offset + int(response.getheader('Content-Length').strip()) - skip
+                while True:
+                    chunk = response.read(self.chunk_size)
+                    if skip:
+                        dropped = min(skip, len(chunk))
+                        chunk, skip = chunk[dropped:], skip - dropped
+                        if not chunk and dropped:
+                            continue
+                    with self.lock:
+                        if self.cancelled:
+                            return
+                        if not chunk:
+                            if self.start_offset + self.written < self.total:
+                                raise http.client.IncompleteRead(b'', self.total - self.start_offset - self.written)
+                            self.done = True
+                            return
+                        self.file.write(chunk)
+                        self.written += len(chunk)
+                    self.monitor.add(self.written)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished.set()
+
+    def cancel(self):
+        """Stop writing. After this returns, the leg never touches its file again, even if its thread is still blocked in a read."""
+        with self.lock:
+            self.cancelled = True
+
+    def end(self):
+        return self.start_offset + self.written
+
+def append_leg(out, leg, upto=None):
+    """Append the data of a finished or cancelled leg to out, up to the absolute offset upto."""
+    length = leg.written if upto is None else upto - leg.start_offset
+    leg.file.seek(0)
+    out.seek(leg.start_offset)
+    out.truncate()
+    remaining = length
+    while remaining > 0:
+        chunk = leg.file.read(min(remaining, 1024*1024))
+        if not chunk:
+            break
+        out.write(chunk)
+        remaining -= len(chunk)
+    leg.file.close()
+
+def collect(out, legs):
+    """Write the longest contiguous data the legs have into out and return its end offset. The legs must be cancelled."""
+    primary = legs[0]
+    hedge = legs[1] if len(legs) > 1 else None
+    if hedge and hedge.end() > primary.end():
+        append_leg(out, primary, upto=hedge.start_offset)
+        append_leg(out, hedge)
+    else:
+        append_leg(out, primary)
+        if hedge:
+            hedge.file.close()
+    return out.tell()
+
+class Stalled(socket.timeout):
+    """Every leg of a download got too slow, and no more can be hedged. Transient, see is_transient."""
+
+def fetch(urls, out, offset, get_reporter, min_rate, timeout):
+    """Make one attempt to download urls[0] from offset into out. Returns the file size, raises the error of the last failed leg."""
+    finished = threading.Event()
+    legs = [Leg(urls[0], offset, finished, timeout)]
+    legs[0].start()
+    while True:
+        finished.wait(POLL_INTERVAL)
+        finished.clear()
+        winner = next((l for l in legs if l.done), None)
+        failed = all(l.error for l in legs)
+        if winner or failed:
+            for l in legs:
+                l.cancel()
+            end = collect(out, legs)
+            if winner:
+                return end
+            raise legs[-1].error
+
+        current = legs[-1]
+        if current.total is not None:
+            get_reporter(current.total).report(max(l.end() for l in legs))
+        if not all(l.monitor.stalled(min_rate) for l in legs if not l.error):
+            continue
+        FAILURES.inc(kind='stall', server=host(current.url))
+        if len(legs) > 1 or not current.ranges: # the hedge is stalled too, or the rest can't be hedged; give up on these connections and let download retry
+            for l in legs:
+                l.cancel()
+            collect(out, legs)
+            raise Stalled("stalled below {} bytes/s".format(min_rate))
+        url = urls[1 % len(urls)]
+        print("\n{} is stalled, requesting the rest again from {}".format(urls[0], url))
+        hedge = Leg(url, current.end(), finished, timeout)
+        hedge.start()
+        legs.append(hedge)
+
+class RangesIgnored(Exception):
+    """The server answered a Range request with the whole file."""
+
+class Piece:
+    """A byte range [start, end) of a segmented download."""
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.received = 0
+
+def probe(session, url, timeout):
+    """Return the size of the file at url if the server supports Range requests, otherwise None."""
+    try:
+        response = session.head(url, allow_redirects=True, timeout=timeout)
+        response.raise_for_status()
+    except requests.RequestException:
+        return None
+    if response.headers.get('Accept-Ranges') != 'bytes' or 'Content-Length' not in response.headers:
+        return None
+    return int(response.headers['Content-Length'])
+
+def fetch_piece(session, urls, piece, out, lock, stop, retries, timeout):
+    """Download the piece into its place in out, resuming after transient errors. Retries go to the next mirror."""
+    for attempt in range(retries+1):
+        url = urls[attempt % len(urls)]
+        offset = piece.start + piece.received
+        try:
+            headers = {'Range': 'bytes={}-{}'.format(offset, piece.end-1)}
+            with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+                if response.status_code == 200:
+                    raise RangesIgnored(url)
+                response.raise_for_status()
+                for chunk in response.iter_content(64*1024):
+                    if stop.is_set():
+                        return
+                    chunk = chunk[:piece.end - offset]
+                    with lock:
+                        out.seek(offset)
+                        out.write(chunk)
+                    offset += len(chunk)
+                    piece.received += len(chunk)
+            if offset < piece.end:
+                raise http.client.IncompleteRead(b'', piece.end - offset)
+            return
+        except Exception as e:
+            if not is_transient(e) or attempt == retries:
+                raise
+            FAILURES.inc(kind='retry', server=host(url))
+            time.sleep(backoff(attempt))
+
+def feed(sink, f, start, end, lock=None, chunk_size=1024*1024):
+    """Pass the bytes [start, end) of the file to sink."""
+    while start < end:
+        with lock or contextlib.nullcontext():
+            f.seek(start)
+            chunk = f.read(min(chunk_size, end - start))
+        if not chunk:
+            break
+        sink(chunk)
+        start += len(chunk)
+
+def download_segmented(session, urls, size, out, reporter, sink, connections, retries, timeout):
+    """Download the file in pieces over several connections into out. Finished pieces are passed to sink in order while the later ones are still downloading.
+    Raises RangesIgnored if the server doesn't support ranges after all and nothing has been passed to sink yet."""
+    pieces = [Piece(start, min(start + PIECE_SIZE, size)) for start in range(0, size, PIECE_SIZE)]
+    lock = threading.Lock()
+    stop = threading.Event()
+    fed = False
+    with ThreadPoolExecutor(max_workers=connections) as pool:
+        futures = [pool.submit(fetch_piece, session, urls, p, out, lock, stop, retries, timeout) for p in pieces]
+        try:
+            for piece, future in zip(pieces, futures):
+                while wait([future], timeout=POLL_INTERVAL).not_done:
+                    reporter.report(sum(p.received for p in pieces))
+                try:
+                    future.result()
+                except RangesIgnored:
+                    if fed:
+                        raise http.client.HTTPException("{} stopped supporting Range requests".format(urls[0]))
+                    raise
+                if sink:
+                    feed(sink, out, piece.start, piece.end, lock)
+                    fed = True
+        finally:
+            stop.set()
+            for f in futures:
+                f.cancel()
+    reporter.report(size)
+
+def record_download(url, size, start):
+    elapsed = time.monotonic() - start
+    BYTES_DOWNLOADED.inc(size, server=host(url))
+    if elapsed > 0:
+        DOWNLOAD_THROUGHPUT.observe(size / elapsed, server=host(url))
+
+def pooled_session(connections=CONNECTIONS):
+    """Return a requests.Session that keeps up to connections connections to each host alive."""
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=connections))
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=connections))
+    return session
+
+def download(url, reporter_class, mirrors=(), min_rate=MIN_RATE, retries=RETRIES, timeout=TIMEOUT, size_hint=None, sink=None, connections=CONNECTIONS, session=None):
+    """Download data from the url to a temporary file and returns the file object. Also takes a reporter object to use to display progress.
+    mirrors are other urls of the same file, used for hedged requests and retries of pieces.
+    If size_hint (e.g. the size from the listing) is at least SEGMENT_THRESHOLD, the file is downloaded in segments over several connections,
+    from the given requests.Session if there is one (see pooled_session).
+    If a sink is given, all the data is passed to it in order, as early as possible."""
+    urls = [url] + list(mirrors)
+    out = tempfile.TemporaryFile()
+    start = time.monotonic()
+    if connections > 1 and size_hint and size_hint >= SEGMENT_THRESHOLD:
+        with contextlib.nullcontext(session) if session else pooled_session(connections) as session:
+            size = probe(session, url, timeout)
+            if size is not None:
+                try:
+                    download_segmented(session, urls, size, out, reporter_class(size), sink, connections, retries, timeout)
+                    sys.stdout.write('\n')
+                    record_download(url, size, start)
+                    return out
+                except RangesIgnored:
+                    print("\n{} ignores Range requests, downloading over a single connection".format(url))
+                    out.seek(0)
+                    out.truncate()
+                except Exception:
+                    FAILURES.inc(kind='download', server=host(url))
+                    raise
+
+    reporter = None
+    def get_reporter(total):
+        nonlocal reporter
+        reporter = reporter or reporter_class(total)
+        return reporter
+
+    offset = 0
+    for attempt in range(retries+1):
+        try:
+            fetch(urls, out, offset, get_reporter, min_rate, timeout)
+            break
+        except Exception as e:
+            if not is_transient(e) or attempt == retries:
+                FAILURES.inc(kind='download', server=host(url))
+                raise
+            FAILURES.inc(kind='retry', server=host(url))
+            offset = out.tell()
+            delay = backoff(attempt)
+            print("\n{}: {}, retrying in {:.0f}s".format(url, e, delay))
+            time.sleep(delay)
+
+    sys.stdout.write('\n')
+    record_download(url, out.tell(), start)
+    if sink:
+        feed(sink, out, 0, out.tell())
+    return out
@@ -0,0 +1,118 @@
+"""
+Integrity checks of extracted maps.
+
+Finds maps that don't match the hashes given by the server's manifest or recorded when they were extracted, and maps truncated by interrupted extractions.
+"""
+
+import os
+import json
+import struct
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+from mapmanager.metrics import CACHE_LOOKUPS
+
+BSP_HEADER = struct.Struct('<4si')
+BSP_LUMP = struct.Struct('<iiii') # fileofs, filelen, version, fourCC
+BSP_LUMP_COUNT = 64
+
+def bsp_truncated(f, size):
+    """Check if any lump of a Source engine .bsp ends past the end of the file. Files in other formats are assumed to be fine."""
+    header = f.read(BSP_HEADER.size + BSP_LUMP.size*BSP_LUMP_COUNT)
+    if len(header) < BSP_HEADER.size:
+        return True
+    ident, _ = BSP_HEADER.unpack_from(header)
+    if ident != b'VBSP':
+        return False
+    if len(header) < BSP_HEADER.size + BSP_LUMP.size*BSP_LUMP_COUNT:
+        return True
+    for i in range(BSP_LUMP_COUNT):
+        offset, length, _, _ = BSP_LUMP.unpack_from(header, BSP_HEADER.size + i*BSP_LUMP.size)
+        if offset + length > size:
+            return True
+    return False
+
+def hash_map(path, chunk_size=4*1024*1024):
+    """Return (sha256, truncated) for the map at path. Runs in a worker process."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        size = os.fstat(f.fileno()).st_size
+        truncated = bsp_truncated(f, size)
+        f.seek(0)
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest(), truncated
+
+class HashCache:
+    """Remembers hashes of the files in a maps directory, keyed by filename, size and mtime.
+    Also stores the expected hash of every map extracted by MapManager."""
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.path)
+
+    def get(self, filename, size, mtime):
+        """Return the cached (sha256, truncated) or None if the file changed since it was hashed."""
+        e = self.entries.get(filename)
+        if e and e.get('size') == size and e.get('mtime') == mtime and 'sha256' in e:
+            return e['sha256'], e['truncated']
+        return None
+
+    def put(self, filename, size, mtime, sha256, truncated):
+        e = self.entries.setdefault(filename, {})
+        e.update(size=size, mtime=mtime, sha256=sha256, truncated=truncated)
+
+    def expected(self, filename):
+        return self.entries.get(filename, {}).get('expected')
+
+    def record_extracted(self, filename, sha256):
+        """Remember the hash of a freshly extracted map so that later runs can tell if it was damaged."""
+        self.entries[filename] = {'expected': sha256}
+        self.save()
+
+def verify_maps(mapsdir, local_mapinfo, remote_mapinfo, cache, workers=None):
+    """Return a list of (MapInfo, reason) for every extracted map that is truncated or whose hash doesn't match the expected one.
+    Only files that changed since the last verification are read; they are hashed in parallel."""
+    remote_digests = {m.key(): m.digest for m in remote_mapinfo if m.digest}
+    bsps = [m for m in local_mapinfo if m.ext == '.bsp']
+
+    results = {}
+    todo = []
+    for m in bsps:
+        cached = cache.get(m.filename(), m.size, m.modified)
+        CACHE_LOOKUPS.inc(cache='hashes', result='hit' if cached else 'miss')
+        if cached:
+            results[m] = cached
+        else:
+            todo.append(m)
+    if todo:
+        with ProcessPoolExecutor(workers) as pool:
+            paths = [os.path.join(mapsdir, m.filename()) for m in todo]
+            for m, result in zip(todo, pool.map(hash_map, paths)):
+                cache.put(m.filename(), m.size, m.modified, *result)
+                results[m] = result
+        cache.save()
+
+    broken = []
+    for m in bsps:
+        sha256, truncated = results[m]
+        expected = remote_digests.get(m.key()) or cache.expected(m.filename())
+        if truncated:
+            broken.append((m, "truncated"))
+        elif expected and sha256 != expected:
+            broken.append((m, "hash mismatch"))
+    return broken
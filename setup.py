@@ -8,7 +8,7 @@ setup(name='mapmanager',
       author_email='krzygorz@gmail.com',
       license='MIT',
       packages=['mapmanager'],
-      install_requires=['beautifulsoup4'],
+      install_requires=['beautifulsoup4', 'html5lib', 'requests'],
       zip_safe=True,
       entry_points = {
         'console_scripts': ['mapmanager=mapmanager.cli:main'],
@@ -0,0 +1,28 @@
+import bz2
+import gzip
+
+import pytest
+
+from mapmanager.formats import CorruptFile, decoder
+
+MAP = b'VBSP' + bytes(range(256)) * 40
+COMPRESS = {'.bsp.bz2': bz2.compress, '.bsp.gz': gzip.compress}
+
+def decode(ext, data, chunk_size=1000):
+    d = decoder(ext)
+    out = b''.join(d.decompress(data[i:i+chunk_size]) for i in range(0, len(data), chunk_size))
+    return out + d.flush()
+
+@pytest.mark.parametrize('ext', COMPRESS)
+def test_whole_file(ext):
+    assert decode(ext, COMPRESS[ext](MAP)) == MAP
+
+@pytest.mark.parametrize('ext', COMPRESS)
+def test_truncated_file(ext):
+    with pytest.raises(CorruptFile):
+        decode(ext, COMPRESS[ext](MAP)[:-20])
+
+@pytest.mark.parametrize('ext', COMPRESS)
+def test_data_after_the_stream(ext):
+    with pytest.raises(CorruptFile):
+        decode(ext, COMPRESS[ext](MAP) * 2)
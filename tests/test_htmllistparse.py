@@ -0,0 +1,109 @@
+import calendar
+
+from mapmanager.htmllistparse import ListingDecoder, iter_json, iter_xml, iter_response, make_entry
+
+class FakeResponse:
+    """Just enough of a streamed requests.Response for iter_response."""
+    def __init__(self, body, content_type='text/html'):
+        self.body = body
+        self.headers = {'Content-Type': content_type}
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i+chunk_size]
+
+def names(entries):
+    return [e.name for e in entries]
+
+UL_PAGE = b'''<!DOCTYPE HTML>
+<html><head><title>Directory listing for /</title></head>
+<body><h1>Directory listing for /</h1><hr>
+<ul>
+<li><a href="zs_bar_v2.bsp.bz2">zs_bar_v2.bsp.bz2</a></li>
+<li><a href="zs_foo_v1.bsp.bz2">zs_foo_v1.bsp.bz2</a></li>
+</ul><hr></body></html>
+'''
+
+PRE_PAGE = b'''<html>
+<head><title>Index of /maps/</title></head>
+<body>
+<h1>Index of /maps/</h1><hr><pre><a href="../">../</a>
+<a href="sub/">sub/</a>                                               01-Oct-2018 10:00                   -
+<a href="zs_bar_v2.bsp.bz2">zs_bar_v2.bsp.bz2</a>                                  23-Oct-2018 12:34            12345678
+<a href="zs_foo_v1.bsp.bz2">zs_foo_v1.bsp.bz2</a>                                  24-Oct-2018 08:00                1024
+</pre><hr></body>
+</html>
+'''
+
+def test_ul_listing_falls_back_to_parse():
+    # python -m http.server; the streaming parser finds no entries outside <pre> and <table>
+    assert names(iter_response(FakeResponse(UL_PAGE), chunk_size=16)) == ['zs_bar_v2.bsp.bz2', 'zs_foo_v1.bsp.bz2']
+
+def test_pre_listing():
+    entries = list(iter_response(FakeResponse(PRE_PAGE), chunk_size=16))
+    assert names(entries) == ['sub/', 'zs_bar_v2.bsp.bz2', 'zs_foo_v1.bsp.bz2']
+    assert entries[1].size == 12345678
+    assert entries[2].size == 1024
+    assert entries[1].modified < entries[2].modified
+
+def test_pre_listing_filtered():
+    entries = iter_response(FakeResponse(PRE_PAGE), lambda name: name.startswith('zs_foo'))
+    assert names(entries) == ['zs_foo_v1.bsp.bz2']
+
+def utc(*t):
+    return calendar.timegm(t + (0,) * (6 - len(t)))
+
+def split_at(data, *offsets):
+    bounds = (0,) + offsets + (len(data),)
+    return [data[a:b] for a, b in zip(bounds, bounds[1:])]
+
+JSON_PAGE = """[
+{ "name":"sub", "type":"directory", "mtime":"Mon, 01 Oct 2018 10:00:00 GMT" },
+{ "name":"zs_bar_v2.bsp.bz2", "type":"file", "mtime":"Tue, 23 Oct 2018 12:34:56 GMT", "size":12345678 },
+{ "name":"zs_café_v1.bsp.bz2", "type":"file", "mtime":"Wed, 24 Oct 2018 08:00:00 GMT", "size":1024 }
+]""".encode()
+
+def test_json_split_mid_object_and_mid_string():
+    mid_string = JSON_PAGE.index(b'zs_bar') + 3
+    mid_object = JSON_PAGE.index(b'"size":1024')
+    entries = list(iter_json(split_at(JSON_PAGE, mid_string, mid_object)))
+    assert names(entries) == ['sub/', 'zs_bar_v2.bsp.bz2', 'zs_café_v1.bsp.bz2']
+    assert entries[1].modified == utc(2018, 10, 23, 12, 34, 56)
+    assert entries[1].size == 12345678
+    assert entries[0].size is None
+
+def test_json_every_byte_split(): # splits the é too
+    chunks = [JSON_PAGE[i:i+1] for i in range(len(JSON_PAGE))]
+    assert list(iter_json(chunks)) == list(iter_json([JSON_PAGE]))
+
+XML_PAGE = b"""<?xml version="1.0"?>
+<list>
+<directory mtime="2018-10-01T10:00:00Z">sub</directory>
+<file mtime="2018-10-23T12:34:56Z" size="12345678">zs_bar_v2.bsp.bz2</file>
+<file mtime="2018-10-24T08:00:00Z" size="1024">zs_foo_v1.bsp.bz2</file>
+</list>
+"""
+
+def test_xml_listing():
+    entries = list(iter_xml(split_at(XML_PAGE, 70, 150)))
+    assert names(entries) == ['sub/', 'zs_bar_v2.bsp.bz2', 'zs_foo_v1.bsp.bz2']
+    assert entries[1].modified == utc(2018, 10, 23, 12, 34, 56)
+    assert entries[2].size == 1024
+
+def test_xml_listing_filtered():
+    assert names(iter_xml([XML_PAGE], lambda name: not name.endswith('/'))) == ['zs_bar_v2.bsp.bz2', 'zs_foo_v1.bsp.bz2']
+
+def test_make_entry_rfc1123_date():
+    entry = make_entry('zs_bar_v2.bsp.bz2', False, 'Tue, 23 Oct 2018 12:34:56 GMT', 10, ListingDecoder(), None)
+    assert entry.modified == utc(2018, 10, 23, 12, 34, 56)
+
+def test_make_entry_iso_date():
+    entry = make_entry('zs_bar_v2.bsp.bz2', False, '2018-10-23T12:34:56Z', '10', ListingDecoder(), None)
+    assert entry.modified == utc(2018, 10, 23, 12, 34, 56)
+    assert entry.size == 10
+
+def test_make_entry_mixed_dates_one_decoder():
+    decoder = ListingDecoder()
+    first = make_entry('a.bsp', False, '2018-10-23T12:34:56Z', 1, decoder, None)
+    second = make_entry('b.bsp', False, 'Tue, 23 Oct 2018 12:34:56 GMT', 1, decoder, None)
+    assert first.modified == second.modified == utc(2018, 10, 23, 12, 34, 56)
@@ -0,0 +1,24 @@
+from mapmanager.mapinfo import MapInfo, MapUpgrade, StreamingPlanner, replan_early
+
+def remote(name, version, modified):
+    return MapInfo(name, version, modified, 1000, '.bsp.bz2')
+
+def test_streaming_planner_sorted_listing():
+    planner = StreamingPlanner([])
+    assert planner.feed(remote('zs_foo', 'v1', 100)) == []
+    assert planner.feed(remote('zs_foo', 'v2', 200)) == []
+    assert planner.feed(remote('zs_goo', 'v1', 100)) == [MapUpgrade(None, remote('zs_foo', 'v2', 200))]
+
+def test_replan_early_unsorted_listing():
+    # sorted by date, or VersionSort: zs_foo_v1 is reported before zs_foo_v2 arrives
+    listing = [remote('zs_foo', 'v1', 100), remote('zs_goo', 'v1', 150), remote('zs_foo', 'v2', 200)]
+    planner = StreamingPlanner([])
+    early = [u for m in listing for u in planner.feed(m)]
+    assert early == [MapUpgrade(None, remote('zs_foo', 'v1', 100))]
+    assert replan_early(early, listing) == [MapUpgrade(remote('zs_foo', 'v1', 100), remote('zs_foo', 'v2', 200))]
+
+def test_replan_early_keeps_final_versions():
+    listing = [remote('zs_foo', 'v1', 100), remote('zs_goo', 'v1', 150)]
+    planner = StreamingPlanner([])
+    early = [u for m in listing for u in planner.feed(m)]
+    assert replan_early(early, listing) == []